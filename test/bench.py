@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+
+import time
+import asyncio
+import tracemalloc
+import threadmsg as tm
+
+
+#------------------------------------------------------------------------------
+# Memory per queued message
+
+def noThread(ctx):
+    return -1
+
+def measure(n, fn):
+
+    # Memory
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    keep = fn(n)
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    size = sum(s.size_diff for s in after.compare_to(before, 'filename'))
+    del keep
+
+    # Time
+    t0 = time.perf_counter()
+    keep = fn(n)
+    t1 = time.perf_counter()
+    del keep
+
+    return size / n, (t1 - t0) / n * 1e9
+
+class OldReply():
+    # Reply object call() used to create, the event was made right away
+    def __init__(self, loop, params={}):
+        self.err = None
+        self.data = None
+        self.loop = loop
+        self.params = params
+        self.event = asyncio.Event() if loop else None
+
+def benchOldAddMsg(n):
+    # What addMsg() used to queue
+    q = []
+    for i in range(n):
+        q.insert(0, {'data': None, 'cb': None})
+    return q
+
+def benchOldCall(n):
+    # What call() used to queue
+    q = []
+    loop = asyncio.get_event_loop()
+    for i in range(n):
+        params = {}
+        params['_funName'] = 'fun'
+        tmr = OldReply(loop, params)
+        def cbCall(ctx, p, r, e):
+            if e:
+                tmr.setError(e)
+            else:
+                tmr.setData(r)
+        q.insert(0, {'data': params, 'cb': cbCall})
+    return q
+
+def benchAddMsg(n):
+    t = tm.ThreadMsg(noThread, start=False)
+    for i in range(n):
+        t.addMsg(None)
+    return t
+
+def benchCall(n):
+    t = tm.ThreadMsg(noThread, start=False, deffk='_funName')
+    r = []
+    for i in range(n):
+        r.append(t.call('fun'))
+    return t, r
+
+async def run():
+
+    # The old queue inserts at the front, keep n small enough to finish
+    n = 20000
+    for name, fn in (('old addMsg', benchOldAddMsg), ('addMsg', benchAddMsg),
+                     ('old call', benchOldCall), ('call', benchCall)):
+        size, ns = measure(n, fn)
+        print('%-10s %6.1f bytes/msg %8.1f ns/msg' % (name, size, ns))
+
+
+if __name__ == '__main__':
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    loop.run_until_complete(run())
@@ -1,7 +1,13 @@
 #!/usr/bin/env python3
 
+import os
 import time
 import asyncio
+import pickle
+import datetime
+import tempfile
+import typing
+import threading
 import threadmsg as tm
 
 try:
@@ -209,6 +215,877 @@ def test_5():
     t1.join(True)
 
 
+#------------------------------------------------------------------------------
+# Test 6
+
+g_poolIds = set()
+async def poolThread(ctx, quit):
+
+    g_poolIds.add(threading.get_ident())
+
+    if quit:
+        return -1
+
+def test_6():
+
+    pool = tm.ThreadMsgPool(minsize=1, maxsize=2, idle=.5)
+    assert 1 == pool.size()
+
+    # Short lived actors should all reuse the same warm thread
+    g_poolIds.clear()
+    for i in range(5):
+        t1 = tm.ThreadMsg(poolThread, (True,), pool=pool)
+        t1.join()
+    assert 1 == len(g_poolIds)
+    assert 1 == pool.size()
+    assert 1 == pool.idleCount()
+
+    # Third actor falls back to a dedicated thread
+    g_poolIds.clear()
+    ts = [tm.ThreadMsg(poolThread, (False,), pool=pool) for i in range(3)]
+    time.sleep(.25)
+    assert 3 == len(g_poolIds)
+    assert 2 == pool.size()
+    assert ts[0].worker and ts[1].worker and not ts[2].worker
+
+    for t in ts:
+        t.join(True)
+    assert 2 == pool.idleCount()
+
+    # Idle threads above minsize expire
+    time.sleep(1)
+    assert 1 == pool.size()
+
+    pool.close()
+    assert 0 == pool.size()
+
+    # Actor churn doesn't pile up idle timers
+    pool = tm.ThreadMsgPool(minsize=0, maxsize=1, idle=60)
+    for i in range(200):
+        t1 = tm.ThreadMsg(poolThread, (True,), pool=pool)
+        t1.join()
+    w = pool.free[0]
+    time.sleep(.1)
+    assert 1 == len(w.loop._scheduled)
+    pool.close()
+
+
+#------------------------------------------------------------------------------
+# Test 7
+
+async def slowThread(ctx):
+    while msg := ctx.getMsg():
+        time.sleep(.005)
+        msg['cb'](ctx, msg['data'], True, None)
+
+def test_7():
+
+    for reject in (True, False):
+
+        res = {'ok': 0, 'over': 0}
+        def onReply(ctx, p, r, e):
+            if isinstance(e, tm.ThreadMsgOverloaded):
+                res['over'] += 1
+            elif r:
+                res['ok'] += 1
+
+        t1 = tm.ThreadMsg(slowThread)
+        t1.setAdmission(tm.ThreadMsgCoDel(target=.01, interval=.05, reject=reject))
+
+        # Offer roughly twice what the thread can handle
+        for i in range(300):
+            t1.addMsg(i, onReply)
+            time.sleep(.0025)
+
+        t1.join(True)
+
+        Log(res)
+        assert 0 < res['over']
+        assert 300 == res['ok'] + res['over'] + len(t1.msgs)
+        assert 0 < t1.admission.drops
+
+
+#------------------------------------------------------------------------------
+# Test 8
+
+async def test_8():
+
+    # Queued messages still look like {'data': ..., 'cb': ...}
+    t1 = tm.ThreadMsg(msgThread, start=False)
+    t1.addMsg(g_testMsg)
+    msg = t1.getMsg()
+    assert msg['data'] == g_testMsg
+    assert msg['cb'] is None
+    assert 'data' in msg and 'nope' not in msg
+    try:
+        msg['nope']
+        assert False
+    except KeyError:
+        pass
+
+    # Reply object is the callback
+    reply = t1.call({'a': 1})
+    msg = t1.getMsg()
+    assert msg['cb'] is reply
+    msg['cb'](t1, msg['data'], 5, None)
+    assert await reply.wait(1)
+    assert 5 == reply.getData()
+
+
+#------------------------------------------------------------------------------
+# Test 9
+
+class addThread(tm.ThreadMsg):
+
+    def __init__(self, n, maxq=0):
+        self.n = n
+        self.callMap = {'add': self.add}
+        super().__init__(self.msgThread, deffk='_funName', maxq=maxq)
+
+    @staticmethod
+    async def msgThread(ctx):
+        while msg := ctx.getMsg():
+            await ctx.mapMsgAsync(None, ctx.callMap, msg)
+
+    def add(self, a):
+        return {'_funName': 'add', 'a': a + self.n}
+
+
+async def test_9():
+
+    # Chain actors
+    t1, t2, t3 = addThread(1), addThread(10, maxq=2), addThread(100, maxq=2)
+    t1.pipe(t2).pipe(t3)
+    reply = t1.call('add', a=0)
+    assert await reply.wait(5)
+    assert 111 == reply.getData()['a']
+    for t in (t1, t2, t3):
+        t.join(True)
+
+    # Pipeline with a slow parallel stage
+    maxDepth = [0]
+    def decode(v):
+        return v * 2
+    def transform(v):
+        time.sleep(.01)
+        return v + 1
+    async def write(v):
+        maxDepth[0] = max(maxDepth[0], p.stats()['stages'][1]['depth'])
+        return v
+
+    p = tm.pipeline(decode, tm.ThreadMsgStage(transform, workers=2), write, maxq=2)
+
+    res = []
+    def onDone(ctx, data, r, e):
+        assert not e
+        res.append(r)
+
+    for i in range(50):
+        p.call(i, onDone)
+
+    reply = p.call(100)
+    assert await reply.wait(5)
+    assert 201 == reply.getData()
+
+    p.join()
+
+    st = p.stats()
+    Log(st)
+    assert sorted(res) == [i * 2 + 1 for i in range(50)]
+    assert 51 == st['total']['count']
+    assert [51, 51, 51] == [v['count'] for v in st['stages']]
+    assert 4 >= maxDepth[0]
+
+    # The slow stage should show up as the busiest
+    busy = max(st['stages'], key=lambda v: v['utilization'])
+    assert 'transform' == busy['name']
+
+    # Async producers wait for room without blocking the loop
+    ticks = [0]
+    async def tick():
+        while True:
+            ticks[0] += 1
+            await asyncio.sleep(.005)
+    ticker = asyncio.ensure_future(tick())
+
+    p = tm.pipeline(decode, tm.ThreadMsgStage(transform, workers=1), maxq=2)
+    t1 = addThread(1, maxq=2)
+    t0 = time.monotonic()
+    for i in range(30):
+        await p.callAsync(i, onDone)
+        await t1.callAsync('add', a=i)
+    reply = await p.callAsync(100)
+    assert await reply.wait(5)
+    assert 201 == reply.getData()
+    Log('ticks', ticks[0], time.monotonic() - t0)
+    assert 20 < ticks[0]
+
+    ticker.cancel()
+    p.join()
+    t1.join(True)
+
+
+#------------------------------------------------------------------------------
+# Test 10
+
+class stuckThread(tm.ThreadMsg):
+
+    def __init__(self):
+        self.callMap = {'stuck': self.stuck, 'fine': self.fine}
+        super().__init__(self.msgThread, deffk='_funName', start=False)
+
+    @staticmethod
+    async def msgThread(ctx):
+        while msg := ctx.getMsg():
+            await ctx.mapMsgAsync(None, ctx.callMap, msg)
+
+    def stuck(self, t):
+        time.sleep(t)
+
+    def fine(self):
+        return True
+
+
+def test_10():
+
+    reports = []
+    def onStall(ctx, info):
+        reports.append(info)
+
+    wd = tm.ThreadMsgWatchdog(threshold=.2, interval=.05, hook=onStall)
+
+    t1 = stuckThread()
+    t1.setWatchdog(wd)
+    t1.start()
+
+    t1.call('fine')
+    time.sleep(.3)
+    assert not len(reports)
+
+    t1.call('stuck', t=.6)
+    t1.call('fine')
+    time.sleep(.8)
+    t1.join(True)
+    wd.stop()
+
+    Log(reports)
+    assert 2 == len(reports)
+    assert set(['handler', 'loop']) == set(v['type'] for v in reports)
+    for v in reports:
+        assert 'stuck' == v['key']
+        assert 1 == v['depth']
+        assert 'in stuck' in v['stack']
+
+
+#------------------------------------------------------------------------------
+# Test 11
+
+def test_11():
+
+    t1 = tm.ThreadMsg(msgThread, start=False)
+    t1.addMsg('early')
+    t1.setFairQueue(tm.ThreadMsgFairQueue(weights={'good': 2}, limits={'noisy': 100}))
+
+    rejected = []
+    def onReject(ctx, p, r, e):
+        assert isinstance(e, tm.ThreadMsgOverloaded)
+        rejected.append(p)
+
+    # One producer floods the queue, the other sends a few messages
+    for i in range(200):
+        t1.addMsg(('noisy', i), onReject, fair_key='noisy')
+    for i in range(6):
+        assert t1.addMsg(('good', i), onReject, fair_key='good')
+
+    assert 100 == len(rejected)
+    assert 107 == len(t1.msgs)
+    assert {None: 1, 'noisy': 100, 'good': 6} == t1.msgs.depths()
+
+    # Good messages get through in order, two for every noisy one
+    order = [t1.getMsgData() for i in range(10)]
+    Log(order)
+    good = [v for v in order if isinstance(v, tuple) and 'good' == v[0]]
+    assert [('good', i) for i in range(6)] == good
+    assert 'early' in order
+
+    # Back to a single queue
+    t1.setFairQueue(None)
+    assert 97 == len(t1.msgs)
+    assert ('noisy', 3) == t1.getMsgData()
+
+
+#------------------------------------------------------------------------------
+# Test 12
+
+class orderThread(tm.ThreadMsg):
+
+    def __init__(self, seen):
+        self.seen = seen
+        self.callMap = {'see': self.see}
+        super().__init__(self.msgThread, deffk='_funName')
+
+    @staticmethod
+    async def msgThread(ctx):
+        while msg := ctx.getMsg():
+            await ctx.mapMsgAsync(None, ctx.callMap, msg)
+
+    def see(self, key, seq):
+        time.sleep(.001)
+        self.seen.setdefault(key, []).append((seq, threading.get_ident()))
+        return seq
+
+
+async def test_12():
+
+    seen = {}
+    g = tm.ThreadMsgShards(lambda: orderThread(seen), 4)
+
+    # Few keys move when a worker is added
+    keys = ['user%d' % i for i in range(1000)]
+    before = [g.shardIndex(k) for k in keys]
+    assert 4 == len(set(before))
+    g.resize(5)
+    moved = sum(1 for k, i in zip(keys, before) if g.shardIndex(k) != i)
+    Log('moved', moved)
+    assert 100 < moved and 350 > moved
+
+    seq = 0
+    for n in (6, 2, 3):
+        for i in range(100):
+            g.call('see', key='k%d' % (i % 10), seq=seq, shard_key='k%d' % (i % 10))
+            seq += 1
+        assert g.resize(n)
+
+    assert 3 == g.size()
+    st = g.stats()
+    Log(st)
+    assert 3 == len(st)
+    assert 0 == sum(v['pending'] + v['depth'] for v in st)
+
+    reply = g.call('see', key='last', seq=seq, shard_key='k0')
+    assert await reply.wait(5)
+    assert seq == reply.getData()
+
+    # Queue options go to the worker, not the function
+    data = []
+    def onDone(ctx, p, r, e):
+        data.append(p)
+    g.call(onDone, 'see', key='opt', seq=0, shard_key='k1', fair_key='p1', urgent=True)
+    g.addMsg({'_funName': 'see', 'key': 'opt', 'seq': 1}, onDone, 'k1', 'p1', True)
+    time.sleep(.2)
+    assert 2 == len(data)
+    assert all('fair_key' not in p and 'urgent' not in p for p in data)
+
+    # Every key was handled in order
+    for k in range(10):
+        v = [x[0] for x in seen['k%d' % k]]
+        assert 30 == len(v)
+        assert sorted(v) == v
+
+    g.join(True)
+
+
+#------------------------------------------------------------------------------
+# Test 13
+
+class tidThread(tm.ThreadMsg):
+
+    def __init__(self, **kwargs):
+        self.callMap = {'tid': self.tid}
+        super().__init__(self.msgThread, deffk='_funName', **kwargs)
+
+    @staticmethod
+    async def msgThread(ctx):
+        while msg := ctx.getMsg():
+            await ctx.mapMsgAsync(None, ctx.callMap, msg)
+
+    def tid(self):
+        return threading.get_ident()
+
+
+async def test_13():
+
+    # Runs as a task on our loop, no extra thread
+    t1 = tidThread(start=False)
+    task = t1.attach()
+
+    # join() can't block the loop the task runs on
+    try:
+        t1.join()
+        assert False
+    except tm.ThreadMsgError as e:
+        Log(e)
+
+    for i in range(3):
+        reply = t1.call('tid')
+        assert await reply.wait(5)
+        assert threading.get_ident() == reply.getData()
+    await t1.joinAsync(True)
+    assert task.done()
+    assert not t1.loop
+
+    # Bounded queues would block the loop
+    try:
+        tidThread(start=False, maxq=2).attach()
+        assert False
+    except tm.ThreadMsgError as e:
+        Log(e)
+
+    # Other threads can join()
+    t1 = tidThread(start=False)
+    task = t1.attach()
+    await asyncio.get_event_loop().run_in_executor(None, t1.join, True)
+    assert task.done()
+
+    # Custom loop factory, for a thread and a pool
+    made = []
+    def factory():
+        made.append(1)
+        return asyncio.new_event_loop()
+
+    t2 = tidThread(loop_factory=factory)
+    reply = t2.call('tid')
+    assert await reply.wait(5)
+    assert threading.get_ident() != reply.getData()
+    await t2.joinAsync(True)
+    assert 1 == len(made)
+
+    pool = tm.ThreadMsgPool(minsize=1, loop_factory=factory)
+    t3 = tidThread(pool=pool)
+    reply = t3.call('tid')
+    assert await reply.wait(5)
+    await t3.joinAsync(True)
+    assert 2 == len(made)
+    pool.close()
+
+
+#------------------------------------------------------------------------------
+# Test 14
+
+async def test_14():
+
+    fname = os.path.join(tempfile.mkdtemp(), 'traffic.gz')
+
+    # Record some traffic
+    rec = tm.ThreadMsgRecorder(fname)
+    t1 = funThread()
+    t1.setRecorder(rec)
+    for i in range(20):
+        t1.call('fun1' if i % 2 else 'fun2', a=1, b=2, skip=lambda: 0)
+        time.sleep(.005)
+    reply = t1.call('fun1', a=1, b=2)
+    assert await reply.wait(5)
+    t1.join(True)
+    rec.close()
+    assert 21 == rec.count
+
+    records = list(tm.ThreadMsgReplay.load(fname))
+    assert 21 == len(records)
+    assert 'fun2' == records[0][1] and 'fun1' == records[1][1]
+    assert {'_funName': 'fun2', 'a': 1, 'b': 2} == records[0][2]
+
+    # Only plain data loads unless the file is trusted
+    unsafe = os.path.join(tempfile.mkdtemp(), 'unsafe')
+    with open(unsafe, 'wb') as f:
+        f.write(pickle.dumps((0, 'k', {'d': datetime.date(2020, 1, 1)}, 0)))
+        f.write(pickle.dumps((0, 'k', {'f': os.getcwd}, 0)))
+    try:
+        tm.ThreadMsgReplay(unsafe)
+        assert False
+    except tm.ThreadMsgError as e:
+        Log(e)
+    assert 2 == len(tm.ThreadMsgReplay(unsafe, trusted=True).records)
+    assert 0 == records[0][0] and records[0][0] < records[-1][0]
+
+    # Play it back at different speeds
+    t2 = funThread()
+    r = tm.ThreadMsgReplay(fname)
+    for speed in (1, 4, 0):
+        t0 = time.monotonic()
+        st = r.replay(t2, speed=speed, timeout=5)
+        Log(st)
+        assert 21 == st['count']
+        assert 0 == st['errors']
+        if speed:
+            assert records[-1][0] / speed <= time.monotonic() - t0
+    t2.join(True)
+
+
+#------------------------------------------------------------------------------
+# Test 15
+
+async def test_15():
+
+    for batch in (False, True):
+
+        t1 = tidThread(start=False)
+        t1.setBatchCallbacks(batch)
+
+        tids = []
+        def onDone(ctx, p, r, e):
+            tids.append(threading.get_ident())
+
+        # Queue everything before the thread starts so it's handled in one go
+        for i in range(50):
+            t1.call(onDone, 'tid')
+        reply = t1.call('tid')
+        t1.start()
+
+        assert await reply.wait(5)
+        await asyncio.sleep(.1)
+        await t1.joinAsync(True)
+
+        assert 50 == len(tids)
+        if batch:
+            # Callbacks ran here, with few wakeups
+            d = tm.ThreadMsgDispatcher.get(asyncio.get_event_loop())
+            Log('batches', d.batches, d.count)
+            assert set(tids) == {threading.get_ident()}
+            assert 51 == d.count
+            assert 10 > d.batches
+        else:
+            assert set(tids) == {reply.getData()}
+
+    # Replies aren't held by a thread function that doesn't return
+    async def loopThread(ctx):
+        while ctx.run:
+            while msg := ctx.getMsg():
+                msg.cb(ctx, msg.data, msg.data['a'] * 2, None)
+            await asyncio.sleep(.01)
+
+    t1 = tm.ThreadMsg(loopThread, start=False)
+    t1.setBatchCallbacks(True)
+    t1.start()
+    for i in range(3):
+        t0 = time.monotonic()
+        reply = t1.call({'a': i})
+        assert await reply.wait(1)
+        assert .5 > time.monotonic() - t0
+        assert i * 2 == reply.getData()
+    t1.stop()
+    await t1.joinAsync()
+
+
+#------------------------------------------------------------------------------
+# Test 16
+
+def interpMul(a, b):
+    return a * b
+
+def interpNap(t):
+    time.sleep(t)
+    return t
+
+interpMap = {'mul': interpMul, 'nap': interpNap}
+
+# The sub-interpreter imports this file by name, not as __main__
+interpTarget = os.path.splitext(os.path.basename(__file__))[0] + ':interpMap'
+
+async def test_16():
+
+    for subinterp in (True, False):
+
+        t1 = tm.ThreadMsgInterp(interpTarget, subinterp=subinterp)
+        assert t1.subinterp == (subinterp and None != tm.interpreters)
+        t1.on_threadmsg_error = Log
+
+        replies = [t1.call('mul', a=i, b=b'xy') for i in range(5)]
+        for i, reply in enumerate(replies):
+            assert await reply.wait(5)
+            assert b'xy' * i == reply.getData()
+
+        reply = t1.call('mul', a=2)
+        assert await reply.wait(5)
+        assert isinstance(reply.getError(), tm.ThreadMsgError)
+
+        await t1.joinAsync(True)
+        assert not t1.interp
+
+        # Messages queued while stopping are still handled
+        t1 = tm.ThreadMsgInterp(interpTarget, subinterp=subinterp)
+        r1 = t1.call('nap', t=.3)
+        time.sleep(.1)
+        r2 = t1.call('mul', a=2, b=b'x')
+        await t1.joinAsync(True)
+        assert await r1.wait(1) and await r2.wait(1)
+        assert .3 == r1.getData()
+        assert b'xx' == r2.getData()
+        assert not t1.interp
+
+        # A target that fails to load stops the thread
+        errs = []
+        t1 = tm.ThreadMsgInterp('nope_mod:interpMap', subinterp=subinterp, start=False)
+        t1.on_threadmsg_error = errs.append
+        t1.start()
+        await t1.joinAsync()
+        Log(errs)
+        assert 1 == len(errs)
+        assert not t1.interp
+
+
+#------------------------------------------------------------------------------
+# Test 17
+
+async def batchThread(ctx, batches):
+    n = 0
+    while msg := ctx.getMsg():
+        n += 1
+    if n:
+        batches.append((n, time.monotonic()))
+
+def test_17():
+
+    batches = []
+    t1 = tm.ThreadMsg(batchThread, (batches,), linger=(10, .3))
+    time.sleep(.1)
+
+    # Full batches wake the thread
+    t0 = time.monotonic()
+    for i in range(30):
+        t1.addMsg(i)
+    time.sleep(.1)
+    Log(batches)
+    assert 30 == sum(v[0] for v in batches)
+    assert 3 >= len(batches)
+    assert all(v[1] - t0 < .1 for v in batches)
+
+    # A partial batch waits for the delay
+    batches.clear()
+    t0 = time.monotonic()
+    t1.addMsg('a')
+    t1.addMsg('b')
+    time.sleep(.5)
+    Log(batches)
+    assert [2] == [v[0] for v in batches]
+    assert .25 < batches[0][1] - t0
+
+    # Urgent messages don't wait
+    batches.clear()
+    t0 = time.monotonic()
+    t1.addMsg('c')
+    t1.addMsg('d', urgent=True)
+    time.sleep(.1)
+    assert [2] == [v[0] for v in batches]
+    assert .1 > batches[0][1] - t0
+
+    t1.join(True)
+
+    # A full bounded queue wakes the thread before the batch is full
+    batches = []
+    t1 = tm.ThreadMsg(batchThread, (batches,), maxq=4, linger=(100, .5))
+    time.sleep(.1)
+    t0 = time.monotonic()
+    for i in range(12):
+        t1.addMsg(i)
+    Log(batches, time.monotonic() - t0)
+    assert .3 > time.monotonic() - t0
+    t1.join(True)
+    assert 12 == sum(v[0] for v in batches)
+
+    # An urgent message taken while the thread is busy doesn't skip the
+    # next linger window
+    done = []
+    async def slowThread(ctx):
+        while msg := ctx.getMsg():
+            if 'slow' == msg.data:
+                time.sleep(.2)
+            done.append((msg.data, time.monotonic()))
+
+    t1 = tm.ThreadMsg(slowThread, linger=(10, .5))
+    time.sleep(.1)
+    t1.addMsg('slow', urgent=True)
+    time.sleep(.05)
+    t1.addMsg('u', urgent=True)
+    time.sleep(.3)
+    assert ['slow', 'u'] == [v[0] for v in done]
+    t0 = time.monotonic()
+    t1.addMsg('n')
+    time.sleep(.7)
+    Log(done)
+    assert 'n' == done[-1][0]
+    assert .4 < done[-1][1] - t0
+
+    t1.join(True)
+
+
+#------------------------------------------------------------------------------
+# Test 18
+
+class handlerThread(tm.ThreadMsg):
+
+    def __init__(self):
+        super().__init__(self.msgThread, deffk='_funName')
+
+    @staticmethod
+    async def msgThread(ctx):
+        while msg := ctx.getMsg():
+            await ctx.mapMsgAsync(None, None, msg)
+
+    @tm.handler('add', coerce=True)
+    def add(self, a: int, b: int = 1):
+        return a + b
+
+    @tm.handler(id=10, check=True)
+    async def neg(self, a: int):
+        return -a
+
+
+class handlerThread2(handlerThread):
+
+    @tm.handler('mul')
+    def mul(self, a, b):
+        return a * b
+
+    # Overrides keep the key, id and options
+    def add(self, a: int, b: int = 1):
+        return a + b + 100
+
+
+async def test_18():
+
+    # Tables are built with the class
+    assert 0 == handlerThread.handlerId('add')
+    assert 10 == handlerThread.handlerId('neg')
+    assert 'mul' not in handlerThread.handlers
+    assert 1 == handlerThread2.handlerId('mul')
+    assert handlerThread2.handlers['neg'] is handlerThread.handlers['neg']
+    assert 0 == handlerThread2.handlerId('add')
+
+    t1 = handlerThread2()
+
+    # By key, with conversion and defaults
+    reply = t1.call('add', a='2', b=3)
+    assert await reply.wait(5)
+    assert 105 == reply.getData()
+
+    reply = t1.call('add', a=2)
+    assert await reply.wait(5)
+    assert 103 == reply.getData()
+
+    # By id
+    reply = t1.call(handlerThread.handlerId('neg'), a=4)
+    assert await reply.wait(5)
+    assert -4 == reply.getData()
+
+    reply = t1.call(0, a=1, b=1)
+    assert await reply.wait(5)
+    assert 102 == reply.getData()
+
+    reply = t1.call('mul', a=3, b=4)
+    assert await reply.wait(5)
+    assert 12 == reply.getData()
+
+    # A key wins over an id, bools aren't ids
+    reply = t1.call(10, 'mul', a=3, b=4)
+    assert await reply.wait(5)
+    assert 12 == reply.getData()
+    try:
+        t1.callHandler(None, {'_funName': False})
+        assert False
+    except tm.ThreadMsgError as e:
+        Log(e)
+        assert not isinstance(e, tm.ThreadMsgParamError)
+
+    # Parameter errors
+    errs = []
+    def onErr(ctx, p, r, e):
+        errs.append(e)
+
+    t1.call(onErr, 'add', b=2)
+    t1.call(onErr, 'add', a='x')
+    t1.call(onErr, 'neg', a='4')
+    t1.call(onErr, 'nope')
+    t1.call(onErr, 99)
+    time.sleep(.5)
+    Log(errs)
+    assert 5 == len(errs)
+    assert all(isinstance(e, tm.ThreadMsgParamError) for e in errs[:3])
+    assert all(isinstance(e, tm.ThreadMsgError) for e in errs)
+
+    # Explicit ids are kept, the rest fill in around them
+    class idThread(tm.ThreadMsg):
+        @tm.handler()
+        def a(self):
+            pass
+        @tm.handler(id=0)
+        def b(self):
+            pass
+        @tm.handler(coerce=True)
+        def c(self, on: bool):
+            return on
+        @tm.handler(check=True)
+        def d(self, v: int = None):
+            return v
+    assert [1, 0, 2, 3] == [idThread.handlerId(k) for k in 'abcd']
+
+    # Defaults aren't checked
+    assert None == idThread.handlers['d'].call(None, {})
+    assert 5 == idThread.handlers['d'].call(None, {'v': 5})
+
+    # Strings convert to bool by name
+    h = idThread.handlers['c']
+    assert False is h.call(None, {'on': 'false'})
+    assert True is h.call(None, {'on': 'Yes'})
+    assert False is h.call(None, {'on': 0})
+    try:
+        h.call(None, {'on': 'maybe'})
+        assert False
+    except tm.ThreadMsgParamError as e:
+        Log(e)
+
+    # Annotations that can't be enforced are refused
+    for t in (typing.Optional[int], typing.List[int]):
+        try:
+            class optThread(tm.ThreadMsg):
+                @tm.handler(check=True)
+                def a(self, v: t):
+                    pass
+            assert False
+        except tm.ThreadMsgError as e:
+            Log(e)
+
+    # Handlers from every base are merged
+    class mThread(tm.ThreadMsg):
+        @tm.handler(id=0)
+        def m(self):
+            return 'm'
+    class nThread(tm.ThreadMsg):
+        @tm.handler(id=1)
+        def n(self):
+            return 'n'
+    class mnThread(mThread, nThread):
+        pass
+    assert ['m', 'n'] == sorted(mnThread.handlers)
+    assert 'n' == mnThread.handlerIds[1].call(None, {})
+
+    # Bases can't share ids
+    class n0Thread(tm.ThreadMsg):
+        @tm.handler()
+        def n(self):
+            pass
+    try:
+        class mn0Thread(mThread, n0Thread):
+            pass
+        assert False
+    except tm.ThreadMsgError as e:
+        Log(e)
+
+    # Ids must be unique
+    try:
+        class badThread(tm.ThreadMsg):
+            @tm.handler(id=1)
+            def a(self):
+                pass
+            @tm.handler(id=1)
+            def b(self):
+                pass
+        assert False
+    except tm.ThreadMsgError as e:
+        Log(e)
+
+    t1.join(True)
+
+
 #------------------------------------------------------------------------------
 
 async def run():
@@ -217,6 +1094,19 @@ async def run():
     test_3()
     await test_4()
     test_5()
+    test_6()
+    test_7()
+    await test_8()
+    await test_9()
+    test_10()
+    test_11()
+    await test_12()
+    await test_13()
+    await test_14()
+    await test_15()
+    await test_16()
+    test_17()
+    await test_18()
 
 
 def main():
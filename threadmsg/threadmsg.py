@@ -3,8 +3,220 @@
 from __future__ import print_function
 import threading
 import asyncio
+import collections
+import sys
+import time
+import math
+import bisect
+import gzip
+import pickle
+import weakref
+import zlib
 import traceback
 import inspect
+import importlib
+import typing
+
+# Sub-interpreters, Python 3.14+
+try:
+    from concurrent import interpreters
+except ImportError:
+    interpreters = None
+
+
+#==================================================================================================
+''' class ThreadMsgError
+
+    Base class for errors raised by ThreadMsg
+
+'''
+class ThreadMsgError(Exception):
+    pass
+
+
+''' class ThreadMsgOverloaded
+
+    Passed to a message callback when the message was rejected or dropped
+    by the admission policy.
+
+'''
+class ThreadMsgOverloaded(ThreadMsgError):
+    pass
+
+
+''' class ThreadMsgParamError
+
+    Raised when a message is missing a parameter, or a parameter fails
+    type validation or conversion, for a @handler function.
+
+'''
+class ThreadMsgParamError(ThreadMsgError):
+    pass
+
+
+''' class ThreadMsgStalled
+
+    Reported by ThreadMsgWatchdog when a handler or event loop is stuck.
+    The details are in the info dict.
+
+'''
+class ThreadMsgStalled(ThreadMsgError):
+
+    def __init__(self, info):
+        self.info = info
+        super().__init__('Stalled %s %s for %.3fs, %d queued\n%s' % (
+                            info['type'], info['key'], info['elapsed'], info['depth'], info['stack']))
+
+
+#==================================================================================================
+''' class ThreadMsgHandler
+
+    A function registered with @handler, with its parameters worked out
+    once when the class is created.
+
+'''
+class ThreadMsgHandler():
+
+    __slots__ = ('key', 'id', 'name', 'f', 'coerce', 'check', 'params')
+
+    # Marks a parameter without a default
+    NODEFAULT = inspect.Parameter.empty
+
+    # Strings accepted when converting to bool
+    BOOLS = {'true': True, '1': True, 'yes': True, 'on': True,
+             'false': False, '0': False, 'no': False, 'off': False, '': False}
+
+    ''' Constructor
+        @param [in] f       - Function, the first parameter is the thread
+        @param [in] name    - Attribute name of the function in the class
+        @param [in] key     - Function key
+        @param [in] id      - Integer id
+        @param [in] coerce  - Convert parameters to their annotated type
+        @param [in] check   - Raise if parameters are not their annotated type
+    '''
+    def __init__(self, f, name, key, id, coerce=False, check=False):
+        self.key = key
+        self.id = id
+        self.name = name
+        self.f = f
+        self.coerce = coerce
+        self.check = check
+
+        hints = {}
+        if coerce or check:
+            try:
+                hints = typing.get_type_hints(f)
+            except Exception as e:
+                raise ThreadMsgError('Handler %s annotations : %s' % (key, e))
+
+        # Tuple of (name, default, type, coerce) for each parameter after self
+        params = []
+        for v in list(inspect.signature(f).parameters.values())[1:]:
+            # Python < 3.11 hints make 'a: int = None' Optional[int]
+            t = hints.get(v.name)
+            if None != t and isinstance(v.annotation, type):
+                t = v.annotation
+            if typing.Any == t:
+                t = None
+            elif None != t and (not isinstance(t, type) or typing.get_origin(t)):
+                raise ThreadMsgError('Handler %s.%s annotation can not be enforced, use a class or Any : %s'
+                                        % (key, v.name, t))
+            params.append((v.name, v.default, t, coerce))
+        self.params = tuple(params)
+
+
+    ''' Converts a parameter to bool, strings must be one of BOOLS
+        @param [in] v   - Value to convert
+    '''
+    @staticmethod
+    def toBool(v):
+        if isinstance(v, str):
+            k = v.strip().lower()
+            if k not in ThreadMsgHandler.BOOLS:
+                raise ValueError('invalid literal for bool(): %r' % v)
+            return ThreadMsgHandler.BOOLS[k]
+        return bool(v)
+
+
+    ''' Calls the function with parameters from a dict
+        @param [in] ctx     - Thread object
+        @param [in] data    - dict of parameters
+    '''
+    def call(self, ctx, data):
+        p = []
+        for name, default, t, coerce in self.params:
+            if name in data:
+                v = data[name]
+            elif default is not self.NODEFAULT:
+                p.append(default)
+                continue
+            else:
+                raise ThreadMsgParamError('Function parameter not found : %s.%s' % (self.key, name))
+            if t and not isinstance(v, t):
+                if not coerce:
+                    raise ThreadMsgParamError('Function parameter %s.%s must be %s, not %s'
+                                                % (self.key, name, t.__name__, type(v).__name__))
+                try:
+                    v = self.toBool(v) if bool is t else t(v)
+                except (TypeError, ValueError) as e:
+                    raise ThreadMsgParamError('Function parameter %s.%s : %s' % (self.key, name, e))
+            p.append(v)
+        return self.f(ctx, *p)
+
+
+''' Decorator that registers a ThreadMsg subclass method as a handler
+
+        The dispatch table is built when the class is created.  Pass None
+        as the function map to mapMsg() / mapMsgAsync() / mapCall() to
+        use it.  Handlers can be called by key, or by integer id which
+        skips the string lookup.
+
+        Handlers from all base classes are merged, and must not use the
+        same id for different keys.  A subclass that overrides a handler
+        without @handler keeps its key, id and options.
+
+    @param [in] key     - Function key, defaults to the function name
+    @param [in] id      - Integer id, if not given the lowest free id is
+                            used, after the explicit ids in the class
+    @param [in] coerce  - Convert parameters to their annotated type,
+                            bool parameters accept true / false, yes / no,
+                            on / off and 1 / 0 strings
+    @param [in] check   - Raise if parameters are not their annotated type
+
+    With coerce or check, annotations must be plain classes or Any.
+    Forms like Optional[int] or list[int] can't be enforced, so they
+    raise ThreadMsgError when the class is created.
+
+    @begincode
+
+        class funThread(tm.ThreadMsg):
+
+            def __init__(self):
+                super().__init__(self.msgThread, deffk='_funName')
+
+            @staticmethod
+            async def msgThread(ctx):
+                while msg := ctx.getMsg():
+                    await ctx.mapMsgAsync(None, None, msg)
+
+            @tm.handler('add', coerce=True)
+            def add(self, a: int, b: int = 1):
+                return a + b
+
+        t1 = funThread()
+        t1.call('add', a='1', b=2)
+
+        # Hot path
+        ADD = funThread.handlerId('add')
+        t1.call(ADD, a=1, b=2)
+
+    @endcode
+'''
+def handler(key=None, id=None, coerce=False, check=False):
+    def reg(f):
+        f.threadmsgHandler = (key if key else f.__name__, id, coerce, check)
+        return f
+    return reg
 
 
 #==================================================================================================
@@ -15,26 +227,151 @@ import inspect
 '''
 class ThreadMsg():
 
+    # Watchdog used by threads that don't set their own
+    watchdog = None
+
+    # Dispatch tables for @handler functions, key -> handler and id -> handler
+    handlers = {}
+    handlerIds = {}
+
+
+    ''' Builds the dispatch tables for @handler functions
+    '''
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+
+        # Merge the bases, nearer bases win like attribute lookup
+        handlers = {}
+        ids = {}
+        for base in reversed(cls.__mro__[1:]):
+            for h in base.__dict__.get('handlers', {}).values():
+                old = ids.get(h.id)
+                if old and old.key != h.key:
+                    raise ThreadMsgError('Handler id %s used by %s and %s' % (h.id, old.key, h.key))
+                old = handlers.get(h.key)
+                if old and old.id != h.id:
+                    del ids[old.id]
+                handlers[h.key] = h
+                ids[h.id] = h
+
+        # Inherited handlers overridden without @handler keep their key,
+        # id and options but call the new function
+        for h in list(handlers.values()):
+            f = cls.__dict__.get(h.name, h.f)
+            if f is h.f or getattr(f, 'threadmsgHandler', None):
+                continue
+            del handlers[h.key]
+            del ids[h.id]
+            if callable(f):
+                h = ThreadMsgHandler(f, h.name, h.key, h.id, h.coerce, h.check)
+                handlers[h.key] = h
+                ids[h.id] = h
+
+        # Explicit ids first, then the rest get the lowest free ids in order
+        regs = []
+        for name, f in cls.__dict__.items():
+            reg = getattr(f, 'threadmsgHandler', None)
+            if reg and callable(f):
+                regs.append((name, f) + reg)
+        regs.sort(key=lambda v: None == v[3])
+
+        nextId = 0
+        for name, f, key, id, coerce, check in regs:
+            if None == id:
+                old = handlers.get(key)
+                if old:
+                    id = old.id
+                else:
+                    while nextId in ids:
+                        nextId += 1
+                    id = nextId
+            if id in ids and ids[id].key != key:
+                raise ThreadMsgError('Handler id %s used by %s and %s' % (id, ids[id].key, key))
+            old = handlers.get(key)
+            if old and old.id != id:
+                del ids[old.id]
+            h = ThreadMsgHandler(f, name, key, id, coerce, check)
+            handlers[key] = h
+            ids[id] = h
+
+        cls.handlers = handlers
+        cls.handlerIds = ids
+
+
+    ''' Returns the integer id of a @handler function
+        @param [in] key     - Function key
+    '''
+    @classmethod
+    def handlerId(cls, key):
+        if key not in cls.handlers:
+            raise ThreadMsgError('Handler not found : %s' % key)
+        return cls.handlers[key].id
+
+
+    ''' class ThreadMsgEnvelope
+        Queued message, supports msg['data'] / msg['cb'] style access
+    '''
+    class ThreadMsgEnvelope():
+
+        __slots__ = ('data', 'cb', 'ts')
+
+        def __init__(self, data, cb, ts):
+            self.data = data
+            self.cb = cb
+            self.ts = ts
+
+        def __getitem__(self, k):
+            if k not in self.__slots__:
+                raise KeyError(k)
+            return getattr(self, k)
+
+        def __setitem__(self, k, v):
+            if k not in self.__slots__:
+                raise KeyError(k)
+            setattr(self, k, v)
+
+        def __contains__(self, k):
+            return k in self.__slots__
+
+        def get(self, k, d=None):
+            return getattr(self, k) if k in self.__slots__ else d
+
 
     ''' class ThreadMsgReply
         Brokers thread reply
+
+        The reply object is itself the message callback, the event is
+        only created if someone actually waits on the reply.
     '''
     class ThreadMsgReply():
 
+        __slots__ = ('err', 'data', 'loop', 'params', 'event', 'done', 'tid')
+
         def __init__(self, loop, params={}):
             self.err = None
             self.data = None
             self.loop = loop
             self.params = params
-            self.event = asyncio.Event(loop=loop) if loop else None
+            self.event = None
+            self.done = False
+            self.tid = threading.get_ident()
+
+        def __call__(self, ctx, p, r, e):
+            if e:
+                self.setError(e)
+            else:
+                self.setData(r)
 
         async def wait(self, to):
-            try:
-                if not self.event.is_set():
-                    await asyncio.wait_for(self.event.wait(), to)
-            except asyncio.TimeoutError as e:
-                return False
-            return self.event.is_set()
+            if not self.done:
+                if not self.event:
+                    self.event = asyncio.Event()
+                try:
+                    if not self.done:
+                        await asyncio.wait_for(self.event.wait(), to)
+                except asyncio.TimeoutError as e:
+                    return False
+            return self.done
 
         def isData(self):
             return None != self.data
@@ -42,21 +379,29 @@ class ThreadMsg():
         def isError(self):
             return None != self.err
 
+        def signal(self):
+            self.done = True
+            event = self.event
+            if not event or not self.loop:
+                return
+            if self.tid == threading.get_ident():
+                event.set()
+            else:
+                self.loop.call_soon_threadsafe(event.set)
+
         def setData(self, data):
             self.data = data
-            if self.loop:
-                self.loop.call_soon_threadsafe(self.event.set)
+            self.signal()
 
         def setError(self, err):
             self.err = err
-            if self.loop:
-                self.loop.call_soon_threadsafe(self.event.set)
+            self.signal()
 
         def getData(self):
-            return self.data if self.event.is_set() else None
+            return self.data if self.done else None
 
         def getError(self):
-            return self.err if self.event.is_set() else None
+            return self.err if self.done else None
 
         def getParams(self):
             return self.params
@@ -73,10 +418,29 @@ class ThreadMsg():
         @param [in] p       - Tuple containing other parameters to pass to the function
         @param [in] start   - True if the thread should start right away.
         @param [in] deffk   - Default function key for function mapping
+        @param [in] pool    - Optional ThreadMsgPool to borrow a running
+                                thread and event loop from.  If the pool
+                                is exhausted a dedicated thread is used.
+        @param [in] maxq    - Maximum queue size, zero for unlimited.
+                                addMsg() blocks while the queue is full.
+                                Not supported with attach().
+        @param [in] loop_factory - Function that returns a new event loop
+                                for the thread, asyncio.new_event_loop
+                                by default
+        @param [in] linger  - Tuple of (max_msgs, max_delay).  If set, the
+                                thread is only woken once max_msgs messages
+                                are queued or the first has waited
+                                max_delay seconds, so messages are handled
+                                in larger batches.  Urgent messages, and
+                                a full queue if maxq is smaller than
+                                max_msgs, wake the thread right away.
+
+        To run on an existing event loop instead of a thread, pass
+        start=False and call attach() from the loop.
     '''
-    def __init__(self, f, p=(), start=True, deffk=None):
+    def __init__(self, f, p=(), start=True, deffk=None, pool=None, maxq=0, loop_factory=None, linger=None):
 
-        self.msgs = []
+        self.msgs = collections.deque()
         self.msgcnt = 0
         self.msgwait = 0
         self.run = True
@@ -85,10 +449,42 @@ class ThreadMsg():
         self.event = None
         self.loop = None
         self.on_threadmsg_error = print
+        self.admission = None
+        self.fairQueue = None
+        self.pipeTo = None
+        self.threadId = None
+        self.busy = None
+        self.recorder = None
+        self.batchCallbacks = False
+        self.batchSize = 64
+        self.batchDelay = .005
+        self.flushTimer = False
+        self.outbox = []
+
+        # Batching window
+        self.linger = linger
+        self.lingerStart = 0
+        self.urgent = False
+
+        # Bounded queue
+        self.maxq = maxq
+        self.space = threading.Condition(self.lock)
+        self.spaceWaiters = collections.deque()
 
         self.defFunKey = deffk
 
+        # Pool
+        self.pool = pool
+        self.worker = None
+        self.future = None
+
+        # Inline on an existing loop
+        self.task = None
+        self.exited = None
+        self.loopFactory = loop_factory if loop_factory else asyncio.new_event_loop
+
         # Thread
+        self.threadArgs = (f, p)
         self.thread = threading.Thread(target=self.threadLoop, args=(f, p,))
         if start:
             self.start()
@@ -106,12 +502,141 @@ class ThreadMsg():
     def setDefaultFunctionKey(self, fk):
         self.defFunKey = fk
 
+    ''' Forwards the return value of mapped functions to another thread
+
+            Return values from mapMsg() / mapMsgAsync() are posted to the
+            next thread instead of being passed to the message callback.
+            The callback travels with the message and is called when the
+            last thread in the chain handles it.  Give the next thread a
+            maxq to throttle this one when it falls behind.
+
+        @param [in] nxt     - ThreadMsg to forward to, None to stop forwarding
+
+        Returns nxt so calls can be chained
+
+        @begincode
+
+            t1.pipe(t2).pipe(t3)
+
+        @endcode
+    '''
+    def pipe(self, nxt):
+        self.pipeTo = nxt
+        return nxt
+
+    ''' Sets the watchdog that monitors this thread
+        @param [in] wd      - ThreadMsgWatchdog object
+
+        Set ThreadMsg.watchdog to monitor every thread started afterwards.
+        Stalled handlers are only seen for messages run with mapMsg() /
+        mapMsgAsync().
+    '''
+    def setWatchdog(self, wd):
+        self.watchdog = wd
+        if wd:
+            wd.watch(self)
+
+    ''' Sets how message callbacks are delivered
+        @param [in] batch   - False to run callbacks on this thread as soon
+                                as the message is handled, lowest latency.
+                                True to queue them to the event loop that
+                                called addMsg() / call(), where they are run
+                                in batches with one wakeup per batch.
+                                Callers without a running loop always get
+                                their callbacks inline.
+        @param [in] size    - Maximum callbacks held before they are sent,
+                                otherwise they are sent each time the
+                                thread function returns or waits
+        @param [in] delay   - Maximum time in seconds a callback is held
+                                while the thread function keeps running
+    '''
+    def setBatchCallbacks(self, batch, size=64, delay=.005):
+        self.batchCallbacks = batch
+        self.batchSize = size
+        self.batchDelay = delay
+
+    ''' Holds a callback for the next batch, called on the thread
+    '''
+    def queueCallback(self, dispatcher, cb, args):
+        self.outbox.append((dispatcher, cb, args))
+        if len(self.outbox) >= self.batchSize:
+            self.flushCallbacks()
+        elif not self.flushTimer and self.loop:
+            self.flushTimer = True
+            self.loop.call_later(self.batchDelay, self.flushTimeout)
+
+    ''' Sends held callbacks once the batch delay is up
+    '''
+    def flushTimeout(self):
+        self.flushTimer = False
+        self.flushCallbacks()
+
+    ''' Sends held callbacks to their dispatchers, one post per loop
+    '''
+    def flushCallbacks(self):
+        if not len(self.outbox):
+            return
+        items = self.outbox
+        self.outbox = []
+        batches = {}
+        for d, cb, args in items:
+            batches.setdefault(d, []).append((cb, args))
+        for d, v in batches.items():
+            d.post(v)
+
+    ''' Records messages handled by mapMsg() / mapMsgAsync()
+        @param [in] rec     - ThreadMsgRecorder object, None to stop recording
+    '''
+    def setRecorder(self, rec):
+        self.recorder = rec
+
+    ''' Returns the function key for a message, used for reporting
+        @param [in] f       - Function or key passed to mapMsg()
+        @param [in] data    - Message data
+    '''
+    def msgKey(self, f, data):
+        if callable(f):
+            return getattr(f, '__name__', str(f))
+        if not isinstance(f, str) or not f:
+            f = self.defFunKey
+        if isinstance(data, dict) and f in data:
+            return data[f]
+        return f
+
+    ''' Enables fair queuing between producers
+        @param [in] fq      - ThreadMsgFairQueue object, or None to go back
+                                to a single FIFO queue
+
+        Messages already queued are kept.
+    '''
+    def setFairQueue(self, fq):
+        self.lock.acquire()
+        q = fq if None != fq else collections.deque()
+        while len(self.msgs):
+            if None != fq:
+                q.put(None, self.msgs.popleft(), True)
+            else:
+                q.append(self.msgs.popleft())
+        self.msgs = q
+        self.fairQueue = fq
+        self.lock.release()
+
+    ''' Sets the admission control policy
+        @param [in] policy  - ThreadMsgCoDel object, or None to accept
+                                all messages
+    '''
+    def setAdmission(self, policy):
+        self.lock.acquire()
+        self.admission = policy
+        self.lock.release()
+
     ''' Maps a call to set functions
 
             You can use this message to map messages to a function.
 
         @param [in] f       - Function or key in the function map
-        @param [in] fm      - Map of functions to call
+        @param [in] fm      - Map of functions to call, None to use the
+                                @handler dispatch table
         @param [in] params  - dict containing function parameters to pass to function
         @param [in] kwargs  - keyword arguments to pass to function
 
@@ -135,6 +660,10 @@ class ThreadMsg():
         # Merge arguments
         _params.update(kwargs)
 
+        # Use the @handler dispatch table
+        if None == _fm:
+            return self.callHandler(_f, _params)
+
         # Look up function name if not callable
         if not callable(_f):
             if not isinstance(_f, str) or not _f:
@@ -158,12 +687,33 @@ class ThreadMsg():
         return _f(*p)
 
 
+    ''' Calls a @handler function
+        @param [in] fk      - Name of the parameter holding the function
+                                key or id, None for the default
+        @param [in] params  - dict containing function parameters
+    '''
+    def callHandler(self, fk, params):
+        if not isinstance(fk, str) or not fk:
+            fk = self.defFunKey
+        if not fk or fk not in params:
+            raise ThreadMsgError('Function not found : %s' % fk)
+        k = params[fk]
+        if isinstance(k, int) and not isinstance(k, bool):
+            h = self.handlerIds.get(k)
+        else:
+            h = self.handlers.get(k)
+        if not h:
+            raise ThreadMsgError('Handler not found : %s' % k)
+        return h.call(self, params)
+
+
     ''' Asynchronously maps a call to set functions
 
             You can use this message to map messages to a function.
 
         @param [in] f       - Function or key in the function map
-        @param [in] fm      - Map of functions to call
+        @param [in] fm      - Map of functions to call, None to use the
+                                @handler dispatch table
         @param [in] params  - dict containing function parameters to pass to function
         @param [in] kwargs  - keyword arguments to pass to function
 
@@ -187,6 +737,13 @@ class ThreadMsg():
         # Merge arguments
         _params.update(kwargs)
 
+        # Use the @handler dispatch table
+        if None == _fm:
+            r = self.callHandler(_f, _params)
+            if inspect.isawaitable(r):
+                r = await r
+            return r
+
         # Look up function name if not callable
         if not callable(_f):
             if not isinstance(_f, str) or not _f:
@@ -219,7 +776,8 @@ class ThreadMsg():
             This function will ensure any callback function is called.
 
         @param [in] f       - Function or key in the function map
-        @param [in] fm      - Map of functions to call
+        @param [in] fm      - Map of functions to call, None to use the
+                                @handler dispatch table
         @param [in] msg     - dict containing function parameters to pass to function
 
         @begincode
@@ -238,16 +796,26 @@ class ThreadMsg():
 
     '''
     def mapMsg(self, f, fm, msg):
+        # Only track the message for a watchdog or recorder
+        track = self.watchdog or self.recorder
+        if track:
+            self.busy = (time.monotonic(), f, msg['data'])
         try:
             r = self.mapCall(f, fm, msg['data'])
         except Exception as e:
+            if track:
+                self.msgDone(msg)
             self.on_threadmsg_error(e)
             if callable(msg['cb']):
                 msg['cb'](self, msg['data'], None, e)
             else:
                 raise e
             return
-        if callable(msg['cb']):
+        if track:
+            self.msgDone(msg)
+        if self.pipeTo:
+            self.pipeTo.addMsg(r, msg['cb'])
+        elif callable(msg['cb']):
             msg['cb'](self, msg['data'], r, None)
         return r
 
@@ -258,7 +826,8 @@ class ThreadMsg():
             This function will ensure any callback function is called.
 
         @param [in] f       - Function or key in the function map
-        @param [in] fm      - Map of functions to call
+        @param [in] fm      - Map of functions to call, None to use the
+                                @handler dispatch table
         @param [in] msg     - dict containing function parameters to pass to function
 
         @begincode
@@ -277,11 +846,17 @@ class ThreadMsg():
 
     '''
     async def mapMsgAsync(self, f, fm, msg):
+        # Only track the message for a watchdog or recorder
+        track = self.watchdog or self.recorder
+        if track:
+            self.busy = (time.monotonic(), f, msg['data'])
         try:
             r = self.mapCall(f, fm, msg['data'])
             if inspect.isawaitable(r):
                 r = await r
         except Exception as e:
+            if track:
+                self.msgDone(msg)
             self.on_threadmsg_error(e)
             if callable(msg['cb']):
                 cbr = msg['cb'](self, msg['data'], None, e)
@@ -290,13 +865,26 @@ class ThreadMsg():
             else:
                 raise e
             return
-        if callable(msg['cb']):
+        if track:
+            self.msgDone(msg)
+        if self.pipeTo:
+            self.pipeTo.addMsg(r, msg['cb'])
+        elif callable(msg['cb']):
             cbr = msg['cb'](self, msg['data'], r, None)
             if inspect.isawaitable(cbr):
                 cbr = await cbr
         return r
 
 
+    ''' Called when mapMsg() / mapMsgAsync() finish a message
+    '''
+    def msgDone(self, msg):
+        busy = self.busy
+        self.busy = None
+        if self.recorder and busy:
+            self.recorder.record(self, busy[1], msg, busy[0], time.monotonic())
+
+
     ''' Find argument by type or return default
         @param [in] i       - Index of argument
         @param [in] t       - Type to find or list of types to find
@@ -323,23 +911,50 @@ class ThreadMsg():
         @params [in] args  - In any order
                                 fn[0]   - Callback function
                                             cb(returnVal, errorObj)
-                                str[0]  - Name of function to call
+                                str[0]  - Name of function to call, or
+                                int[0]  - @handler id of function to call,
+                                            if there is no str
                                 dict[0] - Parameters to pass to function
+        @params [in] fair_key - Producer key used if fair queuing is enabled
+        @params [in] urgent - True to wake the thread right away, ignoring linger
         @params [in] kwargs - Keyword arguments to pass to function
 
         Return value will be passed to the callback if specified
     '''
-    def call(self, *args, **kwargs):
+    def call(self, *args, fair_key=None, urgent=False, **kwargs):
+        params, cb, tmr = self.callParams(args, kwargs)
+        self.addMsg(params, cb, fair_key, urgent)
+        return tmr
+
+
+    ''' Same as call(), but waits for room in a bounded queue without
+        blocking the event loop
+    '''
+    async def callAsync(self, *args, fair_key=None, urgent=False, **kwargs):
+        params, cb, tmr = self.callParams(args, kwargs)
+        await self.addMsgAsync(params, cb, fair_key, urgent)
+        return tmr
+
+
+    ''' Builds the message for call()
+        @params [in] args   - Arguments passed to call()
+        @params [in] kwargs - Keyword arguments passed to call()
+
+        Returns a tuple of (params, callback, reply object or None)
+    '''
+    def callParams(self, args, kwargs):
         cb = self.findByType(0, callable, None, args)
         fn = self.findByType(0, str, '', args)
+        if not fn:
+            fn = self.findByType(0, int, '', args)
         params = self.findByType(0, dict, {}, args)
         params.update(kwargs)
-        if fn:
+        if isinstance(fn, int) or fn:
             if not self.defFunKey:
                 raise Exception('Default function key not set')
             params[self.defFunKey] = fn
 
-        # Callback object
+        # Reply object doubles as the callback
         tmr = None
         if not cb:
             loop = None
@@ -348,21 +963,11 @@ class ThreadMsg():
             except Exception as e:
                 loop = None
 
-            try:
-                # Use the callers loop context
-                tmr = self.ThreadMsgReply(loop, params)
-                def cbCall(ctx, p, r, e):
-                    if e:
-                        tmr.setError(e)
-                    else:
-                        tmr.setData(r)
-                cb = cbCall
-            except Exception as e:
-                tmr = None
-
-        self.addMsg(params, cb)
+            # Use the callers loop context
+            tmr = self.ThreadMsgReply(loop, params)
+            cb = tmr
 
-        return tmr
+        return params, cb, tmr
 
 
     ''' Static function that handles thread
@@ -375,9 +980,11 @@ class ThreadMsg():
         pp.insert(0, ctx)
         p = tuple(pp)
 
+        ctx.threadId = threading.get_ident()
+
         # Create sync event
         ctx.lock.acquire()
-        ctx.event = asyncio.Event(loop=ctx.loop)
+        ctx.event = asyncio.Event()
         ctx.lock.release()
 
         # Allows the exit thread to keep things alive
@@ -395,6 +1002,8 @@ class ThreadMsg():
                     ctx.on_threadmsg_error(e)
                     break
 
+                ctx.flushCallbacks()
+
                 if delay and 0 > delay:
                     ctx.run = False
                     break
@@ -419,6 +1028,8 @@ class ThreadMsg():
                 ctx.run = False
                 ctx.on_threadmsg_error(e)
 
+        ctx.flushCallbacks()
+
         ctx.lock.acquire()
         ctx.event = None
         ctx.lock.release()
@@ -427,10 +1038,35 @@ class ThreadMsg():
     ''' Sets up the async loop for the thread
     '''
     def threadLoop(self, f, p):
-        self.loop = asyncio.new_event_loop()
+        self.loop = self.loopFactory()
         asyncio.set_event_loop(self.loop)
-        self.loop.run_until_complete(self.threadRun(self, f, p))
+        loop = self.loop
+        loop.run_until_complete(self.threadRun(self, f, p))
         self.loop = None
+        loop.close()
+
+
+    ''' Runs the thread function on a pooled worker loop
+    '''
+    async def poolRun(self, f, p):
+        try:
+            await self.threadRun(self, f, p)
+        finally:
+            self.loop = None
+            worker = self.worker
+            self.worker = None
+            self.pool.release(worker)
+
+
+    ''' Runs the thread function as a task on an existing loop
+    '''
+    async def attachRun(self, f, p):
+        try:
+            await self.threadRun(self, f, p)
+        finally:
+            self.loop = None
+            self.task = None
+            self.exited.set()
 
 
     ''' Notify's the thread, i.e. breaks the wait state
@@ -438,7 +1074,10 @@ class ThreadMsg():
     def notify(self):
         self.lock.acquire()
         if self.event:
-            self.loop.call_soon_threadsafe(self.event.set)
+            self.setEvent()
+        if self.maxq:
+            self.space.notify_all()
+            self.wakeSpace()
         self.lock.release()
 
 
@@ -449,6 +1088,11 @@ class ThreadMsg():
 
     '''
     async def wait(self, t):
+        self.flushCallbacks()
+
+        if self.linger:
+            return await self.lingerWait(t)
+
         if not self.run or (len(self.msgs) and self.msgwait != self.msgcnt):
             return
 
@@ -466,6 +1110,44 @@ class ThreadMsg():
             pass
 
 
+    ''' Waits until enough messages are queued, the oldest has waited long
+        enough, an urgent message arrives, or the time runs out.
+        @param [in] t   - Time in seconds to wait.
+    '''
+    async def lingerWait(self, t):
+        maxMsgs, maxDelay = self.linger
+        end = time.monotonic() + t
+
+        while self.run:
+
+            self.lock.acquire()
+            event = self.event
+            depth = len(self.msgs)
+            now = time.monotonic()
+
+            if depth and (self.urgent or depth >= maxMsgs or (self.maxq and depth >= self.maxq)):
+                self.urgent = False
+                self.lock.release()
+                return
+
+            timeout = end - now
+            if depth:
+                timeout = min(timeout, self.lingerStart + maxDelay - now)
+
+            if not event or 0 >= timeout:
+                self.lock.release()
+                return
+
+            # Cleared under the lock so addMsg() can't slip in between
+            event.clear()
+            self.lock.release()
+
+            try:
+                await asyncio.wait_for(event.wait(), timeout)
+            except asyncio.TimeoutError as e:
+                pass
+
+
     ''' Notifies the thread it should quit
     '''
     def stop(self):
@@ -477,28 +1159,235 @@ class ThreadMsg():
     '''
     def start(self):
         self.run = True
+
+        if self.watchdog:
+            self.watchdog.watch(self)
+
+        # Borrow a warm thread / loop if we have a pool
+        if self.pool:
+            self.worker = self.pool.acquire()
+            if self.worker:
+                self.loop = self.worker.loop
+                self.future = asyncio.run_coroutine_threadsafe(self.poolRun(*self.threadArgs), self.loop)
+                return
+
         self.thread.start()
 
 
+    ''' Runs the thread function as a task on an existing event loop
+        instead of in a thread of its own.  Calls from code running on
+        the same loop signal it directly, without a cross thread wakeup.
+        @param [in] loop    - Loop to run on, defaults to the running loop.
+                                Must be called from the loops thread.
+
+        Returns the asyncio task.  Raises ThreadMsgError if the queue is
+        bounded, since producers on the loop would block the only thread
+        that empties it.
+
+        @begincode
+
+            t1 = funThread(start=False)
+            t1.attach()
+
+            reply = t1.call('add', a=1, b=2)
+            await reply.wait(3)
+
+            await t1.joinAsync(True)
+
+        @endcode
+    '''
+    def attach(self, loop=None):
+        if self.maxq:
+            raise ThreadMsgError('maxq can not be used with attach(), producers on the loop would block it')
+
+        self.run = True
+
+        if self.watchdog:
+            self.watchdog.watch(self)
+
+        self.loop = loop if loop else asyncio.get_event_loop()
+        self.threadId = threading.get_ident()
+        self.exited = threading.Event()
+        self.task = self.loop.create_task(self.attachRun(*self.threadArgs))
+        return self.task
+
+
+    ''' Waits for a thread or attached task to exit without blocking the loop
+        @param [in] stop    - True to signal the thread to quit first
+    '''
+    async def joinAsync(self, stop=False):
+        if stop:
+            self.run = False
+            self.notify()
+        if self.task:
+            await self.task
+        elif self.future:
+            await asyncio.wrap_future(self.future)
+            self.future = None
+        elif self.thread.is_alive():
+            await asyncio.get_event_loop().run_in_executor(None, self.thread.join)
+
+
     ''' Notifies the thread it should quit and waits for the thread to terminate
+
+        Raises ThreadMsgError if called from the loop an attached task
+        runs on, use joinAsync() there.
     '''
     def join(self, stop=False):
         if stop:
             self.run = False
             self.notify()
-        if self.thread.is_alive():
+        if self.future:
+            try:
+                self.future.result()
+            except Exception as e:
+                self.on_threadmsg_error(e)
+            self.future = None
+        elif self.task:
+            # Can't wait for a task from the loop it runs on
+            if self.threadId == threading.get_ident():
+                raise ThreadMsgError('join() would block the loop the task runs on, use joinAsync()')
+            self.exited.wait()
+        elif self.thread.is_alive():
             self.thread.join()
 
 
     ''' Adds a message to the threads queue
+        @param [in] msg         - Message data
+        @param [in] cb          - Optional callback cb(ctx, msg, retval, err)
+        @param [in] fair_key    - Producer key used if fair queuing is enabled
+        @param [in] urgent      - True to wake the thread right away,
+                                    ignoring linger
+
+        Returns False if the message was rejected by the admission policy
+        or the producers queue limit, in which case the callback has
+        already received ThreadMsgOverloaded.
+
+        If the queue is bounded this blocks until there is room, so don't
+        call it from the thread that owns the queue, and use addMsgAsync()
+        from a running event loop.
+    '''
+    def addMsg(self, msg, cb=None, fair_key=None, urgent=False):
+        now = time.monotonic()
+        self.lock.acquire()
+        adm = self.admission
+        if adm and adm.reject and adm.drop(now):
+            self.lock.release()
+            self.rejectMsg(msg, cb)
+            return False
+        while self.maxq and self.run and len(self.msgs) >= self.maxq:
+            self.space.wait()
+        return self.queueMsg(msg, cb, fair_key, urgent, now)
+
+
+    ''' Adds a message to the threads queue, waiting for room without
+        blocking the event loop if the queue is bounded
+        @param [in] msg         - Message data
+        @param [in] cb          - Optional callback cb(ctx, msg, retval, err)
+        @param [in] fair_key    - Producer key used if fair queuing is enabled
+        @param [in] urgent      - True to wake the thread right away,
+                                    ignoring linger
+
+        Returns the same as addMsg()
     '''
-    def addMsg(self, msg, cb=None):
+    async def addMsgAsync(self, msg, cb=None, fair_key=None, urgent=False):
+        loop = asyncio.get_running_loop()
+        now = time.monotonic()
         self.lock.acquire()
-        self.msgs.insert(0, {'data':msg, 'cb':cb})
+        adm = self.admission
+        if adm and adm.reject and adm.drop(now):
+            self.lock.release()
+            self.rejectMsg(msg, cb)
+            return False
+        while self.maxq and self.run and len(self.msgs) >= self.maxq:
+            fut = loop.create_future()
+            self.spaceWaiters.append(fut)
+            self.lock.release()
+            await fut
+            self.lock.acquire()
+        return self.queueMsg(msg, cb, fair_key, urgent, now)
+
+
+    ''' Wakes addMsgAsync() callers waiting for room, called with the lock held
+    '''
+    def wakeSpace(self):
+        while len(self.spaceWaiters):
+            fut = self.spaceWaiters.popleft()
+            try:
+                fut.get_loop().call_soon_threadsafe(self.setSpace, fut)
+            except RuntimeError as e:
+                # Loop is gone
+                pass
+
+    @staticmethod
+    def setSpace(fut):
+        if not fut.done():
+            fut.set_result(True)
+
+
+    ''' Queues a message, called with the lock held which it releases
+        @param [in] msg         - Message data
+        @param [in] cb          - Optional callback
+        @param [in] fair_key    - Producer key used if fair queuing is enabled
+        @param [in] urgent      - True to wake the thread right away
+        @param [in] now         - Time the message was added
+    '''
+    def queueMsg(self, msg, cb, fair_key, urgent, now):
+
+        # Deliver the callback back on the callers loop
+        qcb = cb
+        if self.batchCallbacks and callable(cb):
+            qcb = ThreadMsgDispatcher.wrap(cb, self.loop)
+
+        if None != self.fairQueue:
+            if not self.msgs.put(fair_key, self.ThreadMsgEnvelope(msg, qcb, now)):
+                self.lock.release()
+                self.rejectMsg(msg, cb)
+                return False
+        else:
+            self.msgs.append(self.ThreadMsgEnvelope(msg, qcb, now))
         self.msgcnt += 1
-        if self.event:
-            self.loop.call_soon_threadsafe(self.event.set)
+
+        # With linger, only wake the thread to start the timer, when the
+        # batch or the queue is full, or for urgent messages
+        wake = True
+        if self.linger:
+            depth = len(self.msgs)
+            if 1 == depth:
+                self.lingerStart = now
+            if urgent:
+                self.urgent = True
+            else:
+                wake = 1 == depth or depth == self.linger[0] or depth == self.maxq
+
+        if wake and self.event:
+            self.setEvent()
         self.lock.release()
+        return True
+
+
+    ''' Sets the wait event, directly if we're already on the loop thread
+    '''
+    def setEvent(self):
+        if self.threadId == threading.get_ident():
+            self.event.set()
+        else:
+            self.loop.call_soon_threadsafe(self.event.set)
+
+
+    ''' Fails a message with ThreadMsgOverloaded
+        @param [in] msg     - Message data
+        @param [in] cb      - Message callback
+    '''
+    def rejectMsg(self, msg, cb):
+        if not callable(cb):
+            return
+        r = cb(self, msg, None, ThreadMsgOverloaded('Overloaded'))
+        if inspect.isawaitable(r):
+            try:
+                asyncio.ensure_future(r)
+            except Exception as e:
+                r.close()
 
 
     ''' Returns a message from the threads queue
@@ -506,24 +1395,1717 @@ class ThreadMsg():
     def getMsg(self):
         if not len(self.msgs):
             return None
+
+        dropped = []
         self.lock.acquire()
-        msg = self.msgs.pop()
+        msg = self.msgs.popleft() if len(self.msgs) else None
+        if self.maxq:
+            self.space.notify()
+
+        # Measure time in queue and drop if we're overloaded
+        adm = self.admission
+        if adm and msg:
+            now = time.monotonic()
+            adm.update(now - msg.ts, now, len(self.msgs))
+            while not adm.reject and msg and adm.drop(now):
+                dropped.append(msg)
+                msg = self.msgs.popleft() if len(self.msgs) else None
+                if self.maxq:
+                    self.space.notify()
+                if msg:
+                    adm.update(now - msg.ts, now, len(self.msgs))
+
+        if self.maxq and len(self.spaceWaiters):
+            self.wakeSpace()
+
+        # Urgent messages have all been taken, linger again
+        if self.urgent and not len(self.msgs):
+            self.urgent = False
+
         self.lock.release()
+
+        for v in dropped:
+            self.rejectMsg(v.data, v.cb)
+
         return msg
 
 
     ''' Returns message data from the threads queue
     '''
     def getMsgData(self):
-        if not len(self.msgs):
+        msg = self.getMsg()
+        if not msg:
             return None
-        self.lock.acquire()
-        msg = self.msgs.pop()
-        self.lock.release()
-        return msg['data']
+        return msg.data
 
 
     ''' Returns True if the thread should keep running
     '''
     def wantRun(self):
         return self.run
+
+
+#==================================================================================================
+''' class ThreadMsgInterp
+
+    A ThreadMsg whose function map runs in its own sub-interpreter, with
+    its own GIL, so CPU bound threads run in parallel without the cost of
+    separate processes.  call() / addMsg() work as usual, the messages are
+    passed to the sub-interpreter through queues.
+
+    The function map is named by 'module:attribute' since code can't be
+    passed between interpreters, the sub-interpreter imports it.  Message
+    parameters and return values must be shareable between interpreters
+    (str, bytes, int, float, bool, None, tuples of these) or picklable.
+    memoryview objects share their buffer without a copy.
+
+    Without sub-interpreter support, Python before 3.14 or subinterp=False,
+    the function map is imported and called on the thread instead.
+
+    @begincode
+
+        # mymod.py
+        def add(a, b):
+            return a + b
+        callMap = {'add': add}
+
+        t1 = tm.ThreadMsgInterp('mymod:callMap')
+        reply = t1.call('add', a=1, b=2)
+        await reply.wait(3)
+
+    @endcode
+
+'''
+class ThreadMsgInterp(ThreadMsg):
+
+    # Runs in the sub-interpreter first, path is set by prepare_main().
+    # Uses our import path and loads the queue type so queues can be
+    # passed in
+    INTERP_INIT = '''
+import sys
+sys.path[:] = path
+from concurrent import interpreters
+interpreters.Queue
+'''
+
+    # Runs in the sub-interpreter, target, inq and outq are set by
+    # prepare_main()
+    INTERP_MAIN = '''
+import threadmsg.threadmsg
+threadmsg.threadmsg.ThreadMsgInterp.interpMain(target, inq, outq)
+'''
+
+    ''' Constructor
+        @param [in] target      - 'module:attribute' of the function map
+        @param [in] deffk       - Default function key for function mapping
+        @param [in] start       - True if the thread should start right away
+        @param [in] subinterp   - False to always run the function map on
+                                    the thread
+        @param [in] kwargs      - Other ThreadMsg arguments
+    '''
+    def __init__(self, target, deffk='_funName', start=True, subinterp=True, **kwargs):
+        self.target = target
+        self.subinterp = bool(subinterp and interpreters)
+        self.interp = None
+        self.interpThread = None
+        self.interpErr = None
+        self.inq = None
+        self.outq = None
+        self.fm = None
+        super().__init__(self.interpRun, deffk=deffk, start=start, **kwargs)
+
+
+    ''' Imports the function map
+        @param [in] target  - 'module:attribute'
+    '''
+    @staticmethod
+    def loadTarget(target):
+        mod, _, name = target.partition(':')
+        if not mod or not name:
+            raise ThreadMsgError('Invalid target, expected module:attribute : %s' % target)
+        return getattr(importlib.import_module(mod), name)
+
+
+    ''' Calls a function from the map with parameters from a dict
+        @param [in] fm      - Function map
+        @param [in] key     - Function key
+        @param [in] params  - dict of parameters
+    '''
+    @staticmethod
+    def callMapped(fm, key, params):
+        if key not in fm:
+            raise ThreadMsgError('Function map not found : %s' % key)
+        f = fm[key]
+        p = []
+        for v in inspect.signature(f).parameters:
+            if v not in params:
+                raise ThreadMsgError('Function parameter not found : %s' % v)
+            p.append(params[v])
+        return f(*p)
+
+
+    ''' Sub-interpreter main loop
+        @param [in] target  - 'module:attribute' of the function map
+        @param [in] inq     - Queue of (key, params) tuples, None to exit
+        @param [in] outq    - Queue for (return value, error) tuples, the
+                                first tuple reports if the map loaded
+    '''
+    @staticmethod
+    def interpMain(target, inq, outq):
+        try:
+            fm = ThreadMsgInterp.loadTarget(target)
+        except Exception as e:
+            outq.put((None, '%s: %s' % (type(e).__name__, e)))
+            return
+        outq.put((None, None))
+        while True:
+            item = inq.get()
+            if None == item:
+                break
+            key, params = item
+            try:
+                outq.put((ThreadMsgInterp.callMapped(fm, key, dict(params)), None))
+            except Exception as e:
+                outq.put((None, '%s: %s' % (type(e).__name__, e)))
+
+
+    ''' Creates the sub-interpreter, or imports the function map here
+    '''
+    def interpStart(self):
+        if not self.subinterp:
+            self.fm = self.loadTarget(self.target)
+            return
+
+        try:
+            self.interp = interpreters.create()
+            self.inq = interpreters.create_queue()
+            self.outq = interpreters.create_queue()
+            self.interp.prepare_main(path=tuple(sys.path))
+            self.interp.exec(self.INTERP_INIT)
+            self.interp.prepare_main(target=self.target, inq=self.inq, outq=self.outq)
+
+            self.interpErr = None
+            self.interpThread = threading.Thread(target=self.interpExec, daemon=True)
+            self.interpThread.start()
+
+            # Wait for the function map to load
+            r, err = self.interpGet()
+            if err:
+                raise ThreadMsgError(err)
+
+        except Exception as e:
+            self.interpStop()
+            raise ThreadMsgError('Sub-interpreter failed to start : %s' % e)
+
+
+    ''' Runs the sub-interpreter main loop, called on its own thread
+    '''
+    def interpExec(self):
+        try:
+            self.interp.exec(self.INTERP_MAIN)
+        except Exception as e:
+            self.interpErr = e
+
+
+    ''' Returns the next (return value, error) tuple from the
+        sub-interpreter, raises if it has exited
+    '''
+    def interpGet(self):
+        while True:
+            try:
+                return self.outq.get(timeout=.1)
+            except interpreters.QueueEmpty:
+                if self.interpThread.is_alive():
+                    continue
+            # It may have replied just before exiting
+            try:
+                return self.outq.get_nowait()
+            except interpreters.QueueEmpty:
+                raise ThreadMsgError('Sub-interpreter exited : %s' % self.interpErr)
+
+
+    ''' Shuts down the sub-interpreter
+    '''
+    def interpStop(self):
+        if self.interpThread:
+            self.inq.put(None)
+            self.interpThread.join()
+            self.interpThread = None
+        if self.interp:
+            self.interp.close()
+            self.interp = None
+        self.fm = None
+
+
+    ''' Thread function, passes queued messages to the function map
+    '''
+    @staticmethod
+    async def interpRun(ctx):
+
+        if ctx.run and not ctx.interp and None == ctx.fm:
+            try:
+                ctx.interpStart()
+            except Exception as e:
+                ctx.on_threadmsg_error(e)
+                return -1
+
+        msgs = []
+        while msg := ctx.getMsg():
+            msgs.append(msg)
+
+        # Send them all, then collect the replies in order
+        res = [None] * len(msgs)
+        sent = []
+        for i, msg in enumerate(msgs):
+            try:
+                if not isinstance(msg.data, dict):
+                    raise ThreadMsgError('Message is not a dict : %s' % type(msg.data))
+                key = ctx.msgKey(None, msg.data)
+                if ctx.interp:
+                    ctx.inq.put((key, tuple(msg.data.items())))
+                    sent.append(i)
+                elif None == ctx.fm:
+                    raise ThreadMsgError('Function map not loaded : %s' % ctx.target)
+                else:
+                    res[i] = (ctx.callMapped(ctx.fm, key, msg.data), None)
+            except Exception as e:
+                res[i] = (None, e)
+        for i in sent:
+            try:
+                r, err = ctx.interpGet()
+            except ThreadMsgError as e:
+                r, err = None, str(e)
+            res[i] = (r, ThreadMsgError(err) if err else None)
+
+        # Nothing left to run the messages
+        if ctx.interp and not ctx.interpThread.is_alive():
+            ctx.run = False
+
+        for msg, (r, e) in zip(msgs, res):
+            if e:
+                ctx.on_threadmsg_error(e)
+            if callable(msg.cb):
+                cbr = msg.cb(ctx, msg.data, r, e)
+                if inspect.isawaitable(cbr):
+                    await cbr
+
+
+    ''' Runs the thread function, the sub-interpreter is shut down after
+        the final pass so messages queued while stopping are still handled
+    '''
+    @staticmethod
+    async def threadRun(ctx, f, p):
+        try:
+            await ThreadMsg.threadRun(ctx, f, p)
+        finally:
+            ctx.interpStop()
+
+
+#==================================================================================================
+''' class ThreadMsgStage
+
+    A stage in a ThreadMsgPipeline.  Runs a handler on one or more threads
+    and keeps throughput / latency statistics.
+
+'''
+class ThreadMsgStage():
+
+    ''' Constructor
+        @param [in] f       - Handler, receives the output of the previous
+                                stage and returns the input for the next.
+                                Can be a coroutine.
+        @param [in] workers - Number of threads running the handler
+        @param [in] maxq    - Queue size per thread, None to use the
+                                pipeline default
+        @param [in] name    - Name used in statistics
+    '''
+    def __init__(self, f, workers=1, maxq=None, name=None):
+        self.f = f
+        self.workers = max(1, workers)
+        self.maxq = maxq
+        self.name = name if name else getattr(f, '__name__', str(f))
+        self.pipeline = None
+        self.next = None
+        self.threads = []
+        self.lock = threading.Lock()
+        self.reset()
+
+
+    ''' Clears the statistics
+    '''
+    def reset(self):
+        self.lock.acquire()
+        self.started = time.monotonic()
+        self.count = 0
+        self.errors = 0
+        self.busy = 0
+        self.latency = 0
+        self.maxLatency = 0
+        self.lock.release()
+
+
+    ''' Creates the stage threads
+        @param [in] pipeline    - Owning pipeline
+        @param [in] nxt         - Next stage or None if this is the last
+        @param [in] maxq        - Default queue size
+    '''
+    def start(self, pipeline, nxt, maxq):
+        self.pipeline = pipeline
+        self.next = nxt
+        if None == self.maxq:
+            self.maxq = maxq
+        self.reset()
+        self.threads = [ThreadMsg(self.stageThread, (self,), maxq=self.maxq) for i in range(self.workers)]
+
+
+    ''' Thread function for each worker
+    '''
+    @staticmethod
+    async def stageThread(ctx, stage):
+        while msg := ctx.getMsg():
+            await stage.process(ctx, msg)
+
+
+    ''' Queues data on the least busy thread
+        @param [in] data    - Tuple of (value, input, start time)
+        @param [in] cb      - Completion callback
+    '''
+    def put(self, data, cb):
+        self.pick().addMsg(data, cb)
+
+
+    ''' Queues data on the least busy thread without blocking the event loop
+        @param [in] data    - Tuple of (value, input, start time)
+        @param [in] cb      - Completion callback
+    '''
+    async def putAsync(self, data, cb):
+        await self.pick().addMsgAsync(data, cb)
+
+
+    ''' Returns the thread with the fewest queued messages
+    '''
+    def pick(self):
+        t = self.threads[0]
+        for v in self.threads:
+            if len(v.msgs) < len(t.msgs):
+                t = v
+        return t
+
+
+    ''' Runs the handler and passes the result on
+    '''
+    async def process(self, ctx, msg):
+        v, data, t0 = msg.data
+        t1 = time.monotonic()
+        try:
+            r = self.f(v)
+            if inspect.isawaitable(r):
+                r = await r
+        except Exception as e:
+            self.lock.acquire()
+            self.errors += 1
+            self.lock.release()
+            ctx.on_threadmsg_error(e)
+            self.pipeline.complete(data, t0, msg.cb, None, e)
+            return
+
+        t2 = time.monotonic()
+        self.lock.acquire()
+        self.count += 1
+        self.busy += t2 - t1
+        self.latency += t2 - msg.ts
+        self.maxLatency = max(self.maxLatency, t2 - msg.ts)
+        self.lock.release()
+
+        if self.next:
+            self.next.put((r, data, t0), msg.cb)
+        else:
+            self.pipeline.complete(data, t0, msg.cb, r, None)
+
+
+    ''' Returns a dict of statistics
+            count       - Messages handled
+            errors      - Handler exceptions
+            depth       - Messages waiting in the queues
+            throughput  - Messages per second
+            utilization - Fraction of time the threads spent in the handler
+            latency     - Average time in seconds from queued to handled
+            maxLatency  - Worst time from queued to handled
+    '''
+    def stats(self):
+        self.lock.acquire()
+        elapsed = max(time.monotonic() - self.started, 1e-9)
+        r = {
+                'name': self.name,
+                'workers': self.workers,
+                'count': self.count,
+                'errors': self.errors,
+                'depth': sum(len(t.msgs) for t in self.threads),
+                'throughput': self.count / elapsed,
+                'utilization': self.busy / elapsed / self.workers,
+                'latency': self.latency / self.count if self.count else 0,
+                'maxLatency': self.maxLatency
+            }
+        self.lock.release()
+        return r
+
+
+    ''' Waits for the stage threads to drain their queues and exit
+    '''
+    def join(self):
+        for t in self.threads:
+            t.join(True)
+
+
+#==================================================================================================
+''' class ThreadMsgPipeline
+
+    Chains handlers so the output of each stage is the input of the next.
+    The queues between stages are bounded, so a slow stage blocks the
+    stage before it, all the way back to the caller.
+
+    @begincode
+
+        p = tm.pipeline(decode, tm.ThreadMsgStage(transform, workers=4), write)
+
+        reply = p.call(raw)
+        await reply.wait(3)
+
+        print(p.stats())
+        p.join()
+
+    @endcode
+
+'''
+class ThreadMsgPipeline():
+
+    ''' Constructor
+        @param [in] stages  - Handlers or ThreadMsgStage objects
+        @param [in] maxq    - Default queue size per stage thread
+    '''
+    def __init__(self, *stages, maxq=64):
+        if not len(stages):
+            raise ThreadMsgError('Pipeline has no stages')
+        self.stages = [v if isinstance(v, ThreadMsgStage) else ThreadMsgStage(v) for v in stages]
+        self.lock = threading.Lock()
+        self.on_threadmsg_error = print
+        self.reset()
+
+        nxt = None
+        for v in reversed(self.stages):
+            v.start(self, nxt, maxq)
+            nxt = v
+
+
+    ''' Destructor
+    '''
+    def __del__(self):
+        self.join()
+
+
+    ''' Clears the end to end statistics
+    '''
+    def reset(self):
+        self.lock.acquire()
+        self.started = time.monotonic()
+        self.count = 0
+        self.errors = 0
+        self.latency = 0
+        self.maxLatency = 0
+        self.lock.release()
+
+
+    ''' Sends data into the pipeline, blocks if the first stage is full
+        @param [in] data    - Input to the first stage
+        @param [in] cb      - Optional callback cb(ctx, data, retval, err)
+
+        Returns a ThreadMsgReply if no callback is given.  Blocking stalls
+        the whole event loop, so use callAsync() from async code.
+    '''
+    def call(self, data, cb=None):
+        cb, tmr = self.callReply(data, cb)
+        self.stages[0].put((data, data, time.monotonic()), cb)
+        return tmr
+
+
+    ''' Sends data into the pipeline, waits without blocking the event
+        loop if the first stage is full
+        @param [in] data    - Input to the first stage
+        @param [in] cb      - Optional callback cb(ctx, data, retval, err)
+
+        Returns a ThreadMsgReply if no callback is given
+    '''
+    async def callAsync(self, data, cb=None):
+        cb, tmr = self.callReply(data, cb)
+        await self.stages[0].putAsync((data, data, time.monotonic()), cb)
+        return tmr
+
+
+    ''' Returns the callback and reply object for call() / callAsync()
+    '''
+    def callReply(self, data, cb):
+        tmr = None
+        if not cb:
+            loop = None
+            try:
+                loop = asyncio.get_event_loop()
+            except Exception as e:
+                loop = None
+            tmr = ThreadMsg.ThreadMsgReply(loop, data)
+            cb = tmr
+        return cb, tmr
+
+
+    ''' Called by the last stage, or the stage that failed
+    '''
+    def complete(self, data, t0, cb, r, e):
+        t = time.monotonic() - t0
+        self.lock.acquire()
+        if e:
+            self.errors += 1
+        else:
+            self.count += 1
+            self.latency += t
+            self.maxLatency = max(self.maxLatency, t)
+        self.lock.release()
+
+        if callable(cb):
+            try:
+                cbr = cb(self, data, r, e)
+                if inspect.isawaitable(cbr):
+                    asyncio.ensure_future(cbr)
+            except Exception as ex:
+                self.on_threadmsg_error(ex)
+
+
+    ''' Returns a dict with end to end statistics in 'total' and a
+        list of per stage statistics in 'stages'
+    '''
+    def stats(self):
+        self.lock.acquire()
+        elapsed = max(time.monotonic() - self.started, 1e-9)
+        total = {
+                'count': self.count,
+                'errors': self.errors,
+                'throughput': self.count / elapsed,
+                'latency': self.latency / self.count if self.count else 0,
+                'maxLatency': self.maxLatency
+            }
+        self.lock.release()
+        return {'total': total, 'stages': [v.stats() for v in self.stages]}
+
+
+    ''' Waits for all queued data to pass through and shuts down the stages
+    '''
+    def join(self):
+        for v in self.stages:
+            v.join()
+
+
+''' Creates a ThreadMsgPipeline
+    @param [in] stages  - Handlers or ThreadMsgStage objects
+    @param [in] maxq    - Default queue size per stage thread
+'''
+def pipeline(*stages, maxq=64):
+    return ThreadMsgPipeline(*stages, maxq=maxq)
+
+
+#==================================================================================================
+''' class ThreadMsgFairQueue
+
+    Message queue that keeps a separate queue per producer key and serves
+    them with deficit round robin, so one busy producer can't starve the
+    others.  Install with ThreadMsg.setFairQueue().
+
+'''
+class ThreadMsgFairQueue():
+
+    ''' Constructor
+        @param [in] weights - dict of key -> weight, keys not listed have
+                                a weight of 1.  A key with weight 2 gets
+                                twice the messages of a key with weight 1.
+        @param [in] limit   - Maximum depth per key, zero for unlimited
+        @param [in] limits  - dict of key -> maximum depth, overrides limit
+        @param [in] quantum - Messages served per unit of weight each round
+    '''
+    def __init__(self, weights=None, limit=0, limits=None, quantum=1):
+        self.weights = weights if weights else {}
+        self.limit = limit
+        self.limits = limits if limits else {}
+        self.quantum = quantum
+        self.queues = {}
+        self.deficit = {}
+        self.active = collections.deque()
+        self.count = 0
+
+        for k, w in self.weights.items():
+            if 0 >= w:
+                raise ThreadMsgError('Invalid weight for %s : %s' % (k, w))
+
+
+    def __len__(self):
+        return self.count
+
+
+    ''' Returns the number of messages queued for a key
+    '''
+    def depth(self, key):
+        q = self.queues.get(key)
+        return len(q) if q else 0
+
+
+    ''' Returns a dict of key -> number of queued messages
+    '''
+    def depths(self):
+        return {k: len(q) for k, q in self.queues.items()}
+
+
+    ''' Queues a message
+        @param [in] key     - Producer key
+        @param [in] msg     - Message
+        @param [in] force   - Ignore the depth limit
+
+        Returns False if the key is at its depth limit
+    '''
+    def put(self, key, msg, force=False):
+        q = self.queues.get(key)
+        if None == q:
+            q = collections.deque()
+            self.queues[key] = q
+            self.deficit[key] = 0
+            self.active.append(key)
+        elif not force:
+            limit = self.limits.get(key, self.limit)
+            if limit and len(q) >= limit:
+                return False
+        q.append(msg)
+        self.count += 1
+        return True
+
+
+    ''' Removes and returns the next message
+    '''
+    def popleft(self):
+        if not self.count:
+            raise IndexError('pop from an empty queue')
+
+        # Move round the active keys topping up credit until one can send
+        key = self.active[0]
+        while 1 > self.deficit[key]:
+            self.active.rotate(-1)
+            key = self.active[0]
+            self.deficit[key] += self.quantum * self.weights.get(key, 1)
+
+        q = self.queues[key]
+        msg = q.popleft()
+        self.count -= 1
+        self.deficit[key] -= 1
+
+        # Idle keys don't keep their credit
+        if not len(q):
+            self.active.popleft()
+            del self.queues[key]
+            del self.deficit[key]
+
+        return msg
+
+
+#==================================================================================================
+''' class ThreadMsgShards
+
+    Spreads messages over a group of ThreadMsg workers by key.  Messages
+    with the same key always go to the same worker, so they are handled
+    in the order they were sent.  Keys are placed on a consistent hash
+    ring, so changing the number of workers only moves the keys that
+    have to move.
+
+    Workers must call the message callback when done, mapMsg() and
+    mapMsgAsync() do this, so the group knows when a worker is idle.
+
+    @begincode
+
+        g = tm.ThreadMsgShards(funThread, 8)
+
+        reply = g.call('add', a=1, b=2, shard_key=userId)
+        await reply.wait(3)
+
+        # Add workers
+        g.resize(12)
+
+    @endcode
+
+'''
+class ThreadMsgShards():
+
+    ''' class Done
+        Wraps the callback so the group can count outstanding messages
+    '''
+    class Done():
+
+        __slots__ = ('group', 'shard', 'cb')
+
+        def __init__(self, group, shard, cb):
+            self.group = group
+            self.shard = shard
+            self.cb = cb
+
+        def __call__(self, ctx, p, r, e):
+            self.group.done(self.shard)
+            if callable(self.cb):
+                return self.cb(ctx, p, r, e)
+
+
+    ''' Constructor
+        @param [in] factory - Function that returns a new ThreadMsg worker
+        @param [in] n       - Number of workers
+        @param [in] vnodes  - Points on the hash ring per worker
+    '''
+    def __init__(self, factory, n, vnodes=64):
+        self.factory = factory
+        self.vnodes = vnodes
+        self.lock = threading.Lock()
+        self.idle = threading.Condition(self.lock)
+        self.resizing = False
+        self.workers = []
+        self.pending = []
+        self.counts = []
+        self.ring = []
+        self.points = []
+        self.resize(n)
+
+
+    ''' Returns the hash of a key
+    '''
+    @staticmethod
+    def hashKey(k):
+        if not isinstance(k, bytes):
+            k = str(k).encode()
+        return zlib.crc32(k)
+
+
+    ''' Rebuilds the hash ring for the current workers
+    '''
+    def buildRing(self):
+        ring = []
+        for i in range(len(self.workers)):
+            for v in range(self.vnodes):
+                ring.append((self.hashKey('%d:%d' % (i, v)), i))
+        ring.sort()
+        self.ring = [v[1] for v in ring]
+        self.points = [v[0] for v in ring]
+
+
+    ''' Returns the shard index for a key, the least loaded shard if key is None
+    '''
+    def shardIndex(self, key):
+        if None == key:
+            return min(range(len(self.workers)), key=lambda i: self.pending[i])
+        i = bisect.bisect(self.points, self.hashKey(key))
+        return self.ring[i if i < len(self.ring) else 0]
+
+
+    ''' Returns the worker that handles a key
+    '''
+    def shard(self, key):
+        self.lock.acquire()
+        w = self.workers[self.shardIndex(key)]
+        self.lock.release()
+        return w
+
+
+    ''' Called when a worker finishes a message
+    '''
+    def done(self, i):
+        self.lock.acquire()
+        self.pending[i] -= 1
+        if self.resizing and not self.pending[i]:
+            self.idle.notify_all()
+        self.lock.release()
+
+
+    ''' Routes a message to a shard, returns the worker and wrapped callback
+    '''
+    def route(self, key, cb):
+        self.lock.acquire()
+        while self.resizing:
+            self.idle.wait()
+        i = self.shardIndex(key)
+        self.pending[i] += 1
+        self.counts[i] += 1
+        w = self.workers[i]
+        self.lock.release()
+        return w, self.Done(self, i, cb)
+
+
+    ''' Make a call on the worker that owns shard_key
+        @params [in] args       - Same as ThreadMsg.call()
+        @params [in] shard_key  - Routing key, None for the least loaded worker
+        @params [in] fair_key   - Producer key used if fair queuing is enabled
+        @params [in] urgent     - True to wake the worker right away, ignoring linger
+        @params [in] kwargs     - Same as ThreadMsg.call()
+    '''
+    def call(self, *args, shard_key=None, fair_key=None, urgent=False, **kwargs):
+        w = self.workers[0]
+        params, cb, tmr = w.callParams(args, kwargs)
+        w, cb = self.route(shard_key, cb)
+        w.addMsg(params, cb, fair_key, urgent)
+        return tmr
+
+
+    ''' Adds a message to the worker that owns shard_key
+        @params [in] msg        - Message data
+        @params [in] cb         - Optional callback
+        @params [in] shard_key  - Routing key, None for the least loaded worker
+        @params [in] fair_key   - Producer key used if fair queuing is enabled
+        @params [in] urgent     - True to wake the worker right away, ignoring linger
+    '''
+    def addMsg(self, msg, cb=None, shard_key=None, fair_key=None, urgent=False):
+        w, cb = self.route(shard_key, cb)
+        return w.addMsg(msg, cb, fair_key, urgent)
+
+
+    ''' Changes the number of workers
+
+            Waits for the workers to finish the messages they have, so
+            ordering is kept for keys that move.  Calls made while resizing
+            block until it is done, so don't resize from a worker.
+
+        @param [in] n       - New number of workers
+        @param [in] timeout - Maximum time in seconds to wait for the
+                                workers to go idle, None to wait forever
+
+        Returns False if the workers did not go idle in time
+    '''
+    def resize(self, n, timeout=None):
+        n = max(1, n)
+        self.lock.acquire()
+        self.resizing = True
+
+        if not self.idle.wait_for(lambda: not sum(self.pending), timeout):
+            self.resizing = False
+            self.idle.notify_all()
+            self.lock.release()
+            return False
+
+        while len(self.workers) < n:
+            self.workers.append(self.factory())
+            self.pending.append(0)
+            self.counts.append(0)
+        old = self.workers[n:]
+        del self.workers[n:]
+        del self.pending[n:]
+        del self.counts[n:]
+        self.buildRing()
+
+        self.resizing = False
+        self.idle.notify_all()
+        self.lock.release()
+
+        for w in old:
+            w.join(True)
+        return True
+
+
+    ''' Returns the number of workers
+    '''
+    def size(self):
+        return len(self.workers)
+
+
+    ''' Returns a list with a dict of statistics for each shard
+            depth   - Messages waiting in the workers queue
+            pending - Messages sent and not yet finished
+            count   - Messages routed to the shard
+    '''
+    def stats(self):
+        self.lock.acquire()
+        r = [{'depth': len(w.msgs), 'pending': self.pending[i], 'count': self.counts[i]}
+                for i, w in enumerate(self.workers)]
+        self.lock.release()
+        return r
+
+
+    ''' Waits for the workers to exit
+        @param [in] stop    - True to signal the workers to quit first
+    '''
+    def join(self, stop=False):
+        for w in self.workers:
+            w.join(stop)
+
+
+#==================================================================================================
+''' class ThreadMsgRecorder
+
+    Records the messages a ThreadMsg handles with mapMsg() / mapMsgAsync()
+    to a file that ThreadMsgReplay can play back.  Each record is a tuple
+
+        (time queued in seconds from the first record,
+         function key, message data, handler time in seconds)
+
+    pickled one after another.  A file name ending in .gz is compressed.
+    Values in the message data that can't be pickled are left out.
+    Recordings hold whatever the messages held, so treat them like the
+    data itself.
+
+    @begincode
+
+        rec = tm.ThreadMsgRecorder('traffic.gz')
+        t1.setRecorder(rec)
+        ...
+        t1.setRecorder(None)
+        rec.close()
+
+    @endcode
+
+'''
+class ThreadMsgRecorder():
+
+    ''' Constructor
+        @param [in] fname   - File to write
+    '''
+    def __init__(self, fname):
+        self.fname = fname
+        self.lock = threading.Lock()
+        self.start = None
+        self.count = 0
+        self.file = (gzip.open if fname.endswith('.gz') else open)(fname, 'wb')
+
+
+    ''' Destructor
+    '''
+    def __del__(self):
+        self.close()
+
+
+    ''' Writes a record, called by ThreadMsg
+        @param [in] ctx     - ThreadMsg that handled the message
+        @param [in] f       - Function or key passed to mapMsg()
+        @param [in] msg     - The message
+        @param [in] t0      - Time the handler started
+        @param [in] t1      - Time the handler finished
+    '''
+    def record(self, ctx, f, msg, t0, t1):
+        data = msg['data']
+        ts = msg.get('ts') or t0
+        key = ctx.msgKey(f, data)
+
+        self.lock.acquire()
+        if self.file:
+            if None == self.start:
+                self.start = ts
+            try:
+                buf = pickle.dumps((ts - self.start, key, data, t1 - t0), pickle.HIGHEST_PROTOCOL)
+            except Exception as e:
+                buf = pickle.dumps((ts - self.start, key, self.picklable(data), t1 - t0), pickle.HIGHEST_PROTOCOL)
+            self.file.write(buf)
+            self.count += 1
+        self.lock.release()
+
+
+    ''' Returns data with the values that can't be pickled removed
+    '''
+    @staticmethod
+    def picklable(data):
+        if not isinstance(data, dict):
+            return None
+        r = {}
+        for k, v in data.items():
+            try:
+                pickle.dumps(v)
+                r[k] = v
+            except Exception as e:
+                pass
+        return r
+
+
+    ''' Flushes and closes the file
+    '''
+    def close(self):
+        self.lock.acquire()
+        if self.file:
+            self.file.close()
+            self.file = None
+        self.lock.release()
+
+
+#==================================================================================================
+''' class ThreadMsgReplay
+
+    Plays back a file from ThreadMsgRecorder into a ThreadMsg and reports
+    throughput and latency.
+
+    Recordings are pickles, and loading a pickle can run code.  By default
+    only plain data is loaded: dict, list, tuple, set, str, bytes, numbers,
+    None and the types in SAFE.  Anything else raises ThreadMsgError.
+    Only pass trusted=True for files you made yourself and stored safely,
+    never for files from somewhere else.
+
+    @begincode
+
+        r = tm.ThreadMsgReplay('traffic.gz')
+
+        # Original timing, twice as fast, and as fast as possible
+        print(r.replay(t1))
+        print(r.replay(t1, speed=2))
+        print(r.replay(t1, speed=0))
+
+    @endcode
+
+'''
+class ThreadMsgReplay():
+
+    ''' class Done
+        Callback that times a replayed message
+    '''
+    class Done():
+
+        __slots__ = ('replay', 'sent')
+
+        def __init__(self, replay, sent):
+            self.replay = replay
+            self.sent = sent
+
+        def __call__(self, ctx, p, r, e):
+            self.replay.done(time.monotonic() - self.sent, e)
+
+
+    # Classes a recording may use without trusted=True
+    SAFE = {
+            ('builtins', 'bytearray'), ('builtins', 'complex'), ('builtins', 'frozenset'),
+            ('builtins', 'set'), ('collections', 'OrderedDict'), ('decimal', 'Decimal'),
+            ('datetime', 'date'), ('datetime', 'time'), ('datetime', 'datetime'),
+            ('datetime', 'timedelta'), ('datetime', 'timezone')
+        }
+
+
+    ''' class Unpickler
+        Only loads plain data and the classes in SAFE
+    '''
+    class Unpickler(pickle.Unpickler):
+
+        def find_class(self, module, name):
+            if (module, name) not in ThreadMsgReplay.SAFE:
+                raise ThreadMsgError('Recording uses %s.%s, only load it with trusted=True if you trust the file'
+                                        % (module, name))
+            return super().find_class(module, name)
+
+
+    ''' Constructor
+        @param [in] fname   - File written by ThreadMsgRecorder
+        @param [in] trusted - True to allow any pickled class, which can
+                                run code from the file
+    '''
+    def __init__(self, fname, trusted=False):
+        self.fname = fname
+        self.records = list(self.load(fname, trusted))
+        self.lock = threading.Lock()
+        self.finished = threading.Condition(self.lock)
+        self.latency = []
+        self.errors = 0
+
+
+    ''' Reads the records from a file
+        @param [in] fname   - File written by ThreadMsgRecorder
+        @param [in] trusted - True to allow any pickled class
+    '''
+    @classmethod
+    def load(cls, fname, trusted=False):
+        with (gzip.open if fname.endswith('.gz') else open)(fname, 'rb') as f:
+            u = pickle.Unpickler(f) if trusted else cls.Unpickler(f)
+            while True:
+                try:
+                    yield u.load()
+                except EOFError:
+                    return
+
+
+    ''' Called as each replayed message finishes
+    '''
+    def done(self, t, e):
+        self.lock.acquire()
+        self.latency.append(t)
+        if e:
+            self.errors += 1
+        self.finished.notify_all()
+        self.lock.release()
+
+
+    ''' Returns the p'th percentile of a sorted list
+    '''
+    @staticmethod
+    def percentile(v, p):
+        if not len(v):
+            return 0
+        return v[min(len(v) - 1, int(p / 100 * len(v)))]
+
+
+    ''' Returns a dict of avg, p50, p90, p99 and max for a list of times
+    '''
+    @classmethod
+    def summary(cls, v):
+        v = sorted(v)
+        return {
+                'avg': sum(v) / len(v) if len(v) else 0,
+                'p50': cls.percentile(v, 50),
+                'p90': cls.percentile(v, 90),
+                'p99': cls.percentile(v, 99),
+                'max': v[-1] if len(v) else 0
+            }
+
+
+    ''' Sends the recorded messages to a thread and waits for them to finish
+
+            Blocks the calling thread, so don't call it from the thread
+            being replayed into.
+
+        @param [in] ctx     - ThreadMsg to send the messages to
+        @param [in] speed   - 1 for the recorded timing, 2 for twice as
+                                fast, and so on.  0 to send as fast as possible.
+        @param [in] timeout - Maximum time in seconds to wait for replies
+
+        Returns a dict containing
+            count       - Messages finished
+            errors      - Messages that failed
+            elapsed     - Time in seconds from first send to last reply
+            throughput  - Messages per second
+            latency     - Send to reply times, see summary()
+            recorded    - Recorded handler times, see summary()
+    '''
+    def replay(self, ctx, speed=1, timeout=None):
+        self.lock.acquire()
+        self.latency = []
+        self.errors = 0
+        self.lock.release()
+
+        start = time.monotonic()
+        for t, key, data, dur in self.records:
+            if speed:
+                wait = start + t / speed - time.monotonic()
+                if 0 < wait:
+                    time.sleep(wait)
+            if isinstance(data, dict):
+                data = dict(data)
+            ctx.addMsg(data, self.Done(self, time.monotonic()))
+
+        self.lock.acquire()
+        self.finished.wait_for(lambda: len(self.latency) >= len(self.records), timeout)
+        elapsed = time.monotonic() - start
+        r = {
+                'count': len(self.latency),
+                'errors': self.errors,
+                'elapsed': elapsed,
+                'throughput': len(self.latency) / elapsed if elapsed else 0,
+                'latency': self.summary(self.latency),
+                'recorded': self.summary([v[3] for v in self.records])
+            }
+        self.lock.release()
+        return r
+
+
+#==================================================================================================
+''' class ThreadMsgDispatcher
+
+    Runs callbacks posted from other threads on an event loop, in batches.
+    Only the first callback posted after a flush wakes the loop, anything
+    posted before the flush runs is picked up by the same wakeup.  There
+    is one dispatcher per loop, shared by all threads.
+
+'''
+class ThreadMsgDispatcher():
+
+    lock = threading.Lock()
+    dispatchers = weakref.WeakKeyDictionary()
+
+
+    ''' class Callback
+        Stands in for a message callback and posts the call to a dispatcher
+    '''
+    class Callback():
+
+        __slots__ = ('dispatcher', 'cb')
+
+        def __init__(self, dispatcher, cb):
+            self.dispatcher = dispatcher
+            self.cb = cb
+
+        def __call__(self, *args):
+            ctx = args[0] if len(args) else None
+            if isinstance(ctx, ThreadMsg) and ctx.threadId == threading.get_ident():
+                ctx.queueCallback(self.dispatcher, self.cb, args)
+            else:
+                self.dispatcher.post([(self.cb, args)])
+
+
+    ''' Returns the dispatcher for a loop
+    '''
+    @classmethod
+    def get(cls, loop):
+        cls.lock.acquire()
+        d = cls.dispatchers.get(loop)
+        if not d:
+            d = cls(loop)
+            cls.dispatchers[loop] = d
+        cls.lock.release()
+        return d
+
+
+    ''' Wraps a callback so it is run on the callers running loop
+        @param [in] cb      - Callback
+        @param [in] loop    - Loop of the thread that will call cb, if the
+                                caller is on this loop cb is returned as is
+
+        Returns cb if the caller has no running loop
+    '''
+    @classmethod
+    def wrap(cls, cb, loop=None):
+        try:
+            caller = asyncio.get_running_loop()
+        except RuntimeError as e:
+            return cb
+        if caller is loop:
+            return cb
+        return cls.Callback(cls.get(caller), cb)
+
+
+    def __init__(self, loop):
+        # Weak so the dispatcher doesn't keep the loop alive
+        self.loop = weakref.ref(loop)
+        self.lock = threading.Lock()
+        self.pending = []
+        self.batches = 0
+        self.count = 0
+
+
+    ''' Queues callbacks, wakes the loop if this starts a new batch
+        @param [in] items   - List of (callback, args) tuples
+    '''
+    def post(self, items):
+        self.lock.acquire()
+        wake = not len(self.pending)
+        self.pending.extend(items)
+        self.lock.release()
+
+        if wake:
+            loop = self.loop()
+            try:
+                loop.call_soon_threadsafe(self.flush)
+            except (AttributeError, RuntimeError) as e:
+                # Loop is gone
+                self.flush()
+
+
+    ''' Runs all queued callbacks
+    '''
+    def flush(self):
+        self.lock.acquire()
+        items = self.pending
+        self.pending = []
+        self.batches += 1
+        self.count += len(items)
+        self.lock.release()
+
+        for cb, args in items:
+            try:
+                r = cb(*args)
+                if inspect.isawaitable(r):
+                    asyncio.ensure_future(r)
+            except Exception as e:
+                ctx = args[0] if len(args) else None
+                if hasattr(ctx, 'on_threadmsg_error'):
+                    ctx.on_threadmsg_error(e)
+                else:
+                    print(e)
+
+
+#==================================================================================================
+''' class ThreadMsgCoDel
+
+    CoDel style admission control for a ThreadMsg queue.
+
+    The time each message spends in the queue is measured when it is
+    removed by getMsg().  Once that time has stayed above the target for
+    a full interval the queue is considered overloaded and messages are
+    failed with ThreadMsgOverloaded, at a rate that increases with the
+    square root of the number of drops until the queue time falls back
+    below the target.
+
+'''
+class ThreadMsgCoDel():
+
+    ''' Constructor
+        @param [in] target      - Acceptable time in seconds a message may
+                                    wait in the queue
+        @param [in] interval    - Time in seconds the queue time must stay
+                                    above target before dropping starts
+        @param [in] reject      - If True, new messages are rejected in
+                                    addMsg() so the caller gets a fast error.
+                                    If False, queued messages are dropped
+                                    in getMsg() as in classic CoDel.
+    '''
+    def __init__(self, target=.005, interval=.1, reject=True):
+        self.target = target
+        self.interval = interval
+        self.reject = reject
+        self.dropping = False
+        self.firstAbove = 0
+        self.dropNext = 0
+        self.count = 0
+        self.lastCount = 0
+        self.drops = 0
+
+
+    ''' Time of the next drop
+    '''
+    def controlLaw(self, t):
+        return t + self.interval / math.sqrt(self.count)
+
+
+    ''' Updates the state with the queue time of a dequeued message
+        @param [in] sojourn - Time in seconds the message was queued
+        @param [in] now     - Current time
+        @param [in] depth   - Number of messages still in the queue
+    '''
+    def update(self, sojourn, now, depth):
+
+        # Below target, or nothing queued behind this message
+        if sojourn < self.target or not depth:
+            self.firstAbove = 0
+            self.dropping = False
+            return
+
+        if not self.firstAbove:
+            self.firstAbove = now + self.interval
+
+        elif not self.dropping and now >= self.firstAbove:
+            self.dropping = True
+
+            # Start near the old drop rate if we were recently dropping
+            delta = self.count - self.lastCount
+            if 1 < delta and now - self.dropNext < 16 * self.interval:
+                self.count = delta
+            else:
+                self.count = 1
+            self.lastCount = self.count
+            self.dropNext = now
+
+
+    ''' Returns True if a message should be dropped now
+        @param [in] now     - Current time
+    '''
+    def drop(self, now):
+        if not self.dropping or now < self.dropNext:
+            return False
+        self.dropNext = self.controlLaw(self.dropNext)
+        self.count += 1
+        self.drops += 1
+        return True
+
+
+#==================================================================================================
+''' class ThreadMsgWatchdog
+
+    Monitors ThreadMsg objects from a separate thread and reports handlers
+    that run too long and event loops that stop responding, along with
+    the stack of the stuck thread.
+
+    Handlers are only timed for messages run with mapMsg() /
+    mapMsgAsync().  Threads that handle messages some other way are
+    still covered by the event loop check.
+
+'''
+class ThreadMsgWatchdog():
+
+    ''' Constructor
+        @param [in] threshold   - Time in seconds before a handler or loop
+                                    is considered stalled
+        @param [in] interval    - Time in seconds between checks, defaults
+                                    to a quarter of the threshold
+        @param [in] hook        - Function called as hook(ctx, info) when
+                                    a stall is detected.  If not set,
+                                    ThreadMsgStalled is passed to the
+                                    threads on_threadmsg_error()
+
+        info is a dict containing
+            type    - 'handler' or 'loop'
+            key     - Function key of the running message, if known
+            elapsed - Time in seconds the thread has been stuck
+            depth   - Number of queued messages
+            thread  - Thread id
+            stack   - Formatted stack of the stuck thread
+    '''
+    def __init__(self, threshold=1, interval=None, hook=None):
+        self.threshold = threshold
+        self.interval = interval if interval else threshold / 4
+        self.hook = hook
+        self.run = True
+        self.lock = threading.Lock()
+        self.event = threading.Event()
+        self.actors = weakref.WeakKeyDictionary()
+        self.thread = threading.Thread(target=self.threadLoop, daemon=True)
+        self.thread.start()
+
+
+    ''' class State
+        Watchdog state for a single ThreadMsg
+    '''
+    class State():
+
+        __slots__ = ('ping', 'busy', 'stalled')
+
+        def __init__(self):
+            self.ping = 0
+            self.busy = None
+            self.stalled = False
+
+        def pong(self):
+            self.ping = 0
+            self.stalled = False
+
+
+    ''' Starts monitoring a thread
+        @param [in] ctx     - ThreadMsg object
+    '''
+    def watch(self, ctx):
+        self.lock.acquire()
+        if ctx not in self.actors:
+            self.actors[ctx] = self.State()
+        self.lock.release()
+
+
+    ''' Stops monitoring a thread
+        @param [in] ctx     - ThreadMsg object
+    '''
+    def unwatch(self, ctx):
+        self.lock.acquire()
+        self.actors.pop(ctx, None)
+        self.lock.release()
+
+
+    ''' Watchdog thread
+    '''
+    def threadLoop(self):
+        while self.run:
+            self.check()
+            self.event.wait(self.interval)
+
+
+    ''' Checks all monitored threads
+    '''
+    def check(self):
+        self.lock.acquire()
+        actors = list(self.actors.items())
+        self.lock.release()
+
+        now = time.monotonic()
+        for ctx, st in actors:
+
+            # Handler running too long
+            busy = ctx.busy
+            if busy and busy is not st.busy and self.threshold <= now - busy[0]:
+                st.busy = busy
+                self.report(ctx, 'handler', ctx.msgKey(busy[1], busy[2]), now - busy[0])
+
+            # Event loop not responding
+            loop = ctx.loop
+            if not loop or not ctx.event:
+                st.ping = 0
+            elif not st.ping:
+                try:
+                    st.ping = now
+                    loop.call_soon_threadsafe(st.pong)
+                except RuntimeError as e:
+                    st.ping = 0
+            elif not st.stalled and self.threshold <= now - st.ping:
+                st.stalled = True
+                key = ctx.msgKey(busy[1], busy[2]) if busy else None
+                self.report(ctx, 'loop', key, now - st.ping)
+
+
+    ''' Captures the stack and reports a stall
+    '''
+    def report(self, ctx, what, key, elapsed):
+        frame = sys._current_frames().get(ctx.threadId)
+        info = {
+                'type': what,
+                'key': key,
+                'elapsed': elapsed,
+                'depth': len(ctx.msgs),
+                'thread': ctx.threadId,
+                'stack': ''.join(traceback.format_stack(frame)) if frame else ''
+            }
+        try:
+            if self.hook:
+                self.hook(ctx, info)
+            else:
+                ctx.on_threadmsg_error(ThreadMsgStalled(info))
+        except Exception as e:
+            print(e)
+
+
+    ''' Stops the watchdog thread
+    '''
+    def stop(self):
+        self.run = False
+        self.event.set()
+        if self.thread.is_alive() and threading.current_thread() != self.thread:
+            self.thread.join()
+
+
+#==================================================================================================
+''' class ThreadMsgPool
+
+    Keeps a pool of running threads, each with its own event loop, that
+    ThreadMsg objects can borrow instead of creating a new thread and loop.
+
+'''
+class ThreadMsgPool():
+
+
+    ''' class Worker
+        A thread running an event loop forever
+    '''
+    class Worker():
+
+        def __init__(self, loopFactory):
+            self.idle = 0
+            self.timer = None
+            self.loop = loopFactory()
+            self.thread = threading.Thread(target=self.threadLoop, daemon=True)
+            self.thread.start()
+
+        def threadLoop(self):
+            asyncio.set_event_loop(self.loop)
+            self.loop.run_forever()
+            self.loop.close()
+
+        def stop(self):
+            self.loop.call_soon_threadsafe(self.loop.stop)
+
+
+    ''' Constructor
+        @param [in] minsize - Number of threads to keep warm at all times
+        @param [in] maxsize - Maximum number of threads owned by the pool
+        @param [in] idle    - Time in seconds an idle thread above minsize
+                                is kept before it is shut down.  None to
+                                keep idle threads forever.
+        @param [in] loop_factory - Function that returns a new event loop,
+                                asyncio.new_event_loop by default
+    '''
+    def __init__(self, minsize=0, maxsize=8, idle=60, loop_factory=None):
+        self.loopFactory = loop_factory if loop_factory else asyncio.new_event_loop
+        self.minsize = minsize
+        self.maxsize = max(minsize, maxsize)
+        self.idle = idle
+        self.run = True
+        self.lock = threading.Lock()
+        self.free = []
+        self.workers = 0
+
+        for i in range(self.minsize):
+            self.free.append(self.Worker(self.loopFactory))
+            self.workers += 1
+
+
+    ''' Destructor
+    '''
+    def __del__(self):
+        self.close()
+
+
+    ''' Returns an idle worker, a new worker if there is room, or None
+        if the pool is exhausted
+    '''
+    def acquire(self):
+        self.lock.acquire()
+        if not self.run or (not len(self.free) and self.workers >= self.maxsize):
+            self.lock.release()
+            return None
+        if len(self.free):
+            w = self.free.pop()
+            self.lock.release()
+            return w
+        self.workers += 1
+        self.lock.release()
+        return self.Worker(self.loopFactory)
+
+
+    ''' Returns a worker to the pool
+        @param [in] w   - Worker returned from acquire()
+    '''
+    def release(self, w):
+        self.lock.acquire()
+        keep = self.run
+        if keep:
+            w.idle = time.monotonic()
+            self.free.append(w)
+        else:
+            self.workers -= 1
+        self.lock.release()
+
+        if not keep:
+            w.stop()
+        elif None != self.idle:
+            w.loop.call_soon_threadsafe(self.arm, w)
+
+
+    ''' Starts the idle timer for a worker, runs on the workers loop
+        @param [in] w   - Worker that was released
+
+        A worker has at most one timer, expire() checks how long it
+        has really been idle and starts it again if needed.
+    '''
+    def arm(self, w):
+        if not w.timer:
+            w.timer = w.loop.call_later(self.idle, self.expire, w)
+
+
+    ''' Shuts down workers that have been idle too long
+        @param [in] w   - Worker that scheduled the check
+    '''
+    def expire(self, w):
+        w.timer = None
+        now = time.monotonic()
+        stop = []
+        self.lock.acquire()
+
+        # Oldest idle workers are at the front
+        while len(self.free) and self.workers > self.minsize and self.idle <= now - self.free[0].idle:
+            stop.append(self.free.pop(0))
+            self.workers -= 1
+
+        # Timers may fire a little early, check again later
+        wait = 0
+        if w in self.free and self.workers > self.minsize:
+            wait = self.idle - (now - w.idle)
+
+        self.lock.release()
+
+        for v in stop:
+            v.stop()
+        if 0 < wait:
+            w.timer = w.loop.call_later(wait, self.expire, w)
+
+
+    ''' Returns the number of threads owned by the pool
+    '''
+    def size(self):
+        return self.workers
+
+
+    ''' Returns the number of idle threads in the pool
+    '''
+    def idleCount(self):
+        return len(self.free)
+
+
+    ''' Shuts down idle threads, busy threads are shut down when released
+    '''
+    def close(self):
+        self.lock.acquire()
+        self.run = False
+        stop = self.free
+        self.free = []
+        self.workers -= len(stop)
+        self.lock.release()
+        for w in stop:
+            w.stop()